@@ -8,10 +8,12 @@
 #          Searches timestamps stored as metadata in mkv EBML header.
 # Version: 0.1
 import argparse
+import functools
 import glob
 import os
 import re
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 STARTTIMESIGNATURE = b"STARTTIME..."  # \x44\x87\x92"
 
@@ -19,16 +21,7 @@ STARTTIMESIGNATURE = b"STARTTIME..."  # \x44\x87\x92"
 def getBytesFromString(string):
     # Returns a string converted to bytes. Hex-values converted, but not other characters.
     # Example: "[\x41-\x5A]" =>b'[A-Z]'
-    result_bytes = b''
-    i = 0
-    while i < len(string):
-        if string[i] == "\\" and i + 4 <= len(string):
-            result_bytes += bytes.fromhex(string[i+2:i+4])
-            i += 4
-        else:
-            result_bytes += bytes(string[i], 'utf-8')
-            i += 1
-    return result_bytes
+    return re.sub(rb'\\x([0-9A-Fa-f]{2})', lambda match: bytes.fromhex(match.group(1).decode()), string.encode('utf-8'))
 
 def carveInBytes(data, carve_string):
     if carve_string:
@@ -36,46 +29,73 @@ def carveInBytes(data, carve_string):
         return carve_list
     return []
 
-def scanMKVfile(mkv_file_path, carve_string):
-    folder_path, mkv_file = os.path.split(os.path.realpath(mkv_file_path))
+def scanMKVfile(mkv_file_path, carve_string, not_folder_path):
+    # Returns the matching header bytes, or None if the file was moved to not_folder_path.
+    mkv_file = os.path.basename(mkv_file_path)
 
-    with open(mkv_file_path, "rb") as mkv_filehandle:
-        # Read four clusers to make sure we get the EMBL header
-        header = mkv_filehandle.read(2048)
-        offsets = carveInBytes(header, carve_string)
-        if offsets:
-            outputHeadersFile.write(header[offsets[0][0]:offsets[0][1]])
-        else:
-            new_file_path = os.path.join(folder_path, "not")
-            if not os.path.exists(new_file_path):
-                os.makedirs(new_file_path)
-            new_file_path = os.path.join(new_file_path, mkv_file)
-            os.rename(mkv_file_path, new_file_path)
-            print(f"Moved to {new_file_path}")
+    # Read four clusers to make sure we get the EMBL header
+    if hasattr(os, 'pread'):
+        mkv_fd = os.open(mkv_file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            header = os.pread(mkv_fd, 2048, 0)
+        finally:
+            os.close(mkv_fd)
+    else:
+        with open(mkv_file_path, 'rb') as mkv_filehandle:
+            header = mkv_filehandle.read(2048)
+
+    offsets = carveInBytes(header, carve_string)
+    if offsets:
+        return header[offsets[0][0]:offsets[0][1]]
+    else:
+        new_file_path = os.path.join(not_folder_path, mkv_file)
+        os.rename(mkv_file_path, new_file_path)
+        print(f"Moved to {new_file_path}")
+    return None
 
 # 638031422079299991
 # 638032[5-7][0-9]{11}
 # 6380[0-2][0-9]{13}
-outputHeadersFile = open("/media/MasterData4/AgentDVR-Win/headers.1b", "wb")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Scans .mkv files within a timeframe")
     parser.add_argument('path', help='File or folder to extract from.')
     parser.add_argument('timeframe', help='Regex-string for timeframe search.')
+    parser.add_argument('-o', '--output', help='File to write the found headers to. Default is "headers.1b" in path')
 
     args = parser.parse_args()
 
     carve_string = STARTTIMESIGNATURE + getBytesFromString(args.timeframe)
 
     if os.path.isfile(args.path):
-        scanMKVfile(args.path, carve_string)
+        mkv_files = [args.path]
+        folder_path = os.path.dirname(os.path.realpath(args.path))
     elif os.path.isdir(args.path):
         mkv_files = glob.glob(os.path.join(args.path, "*.mkv"))
-        for mkv_file in mkv_files:
-            scanMKVfile(mkv_file, carve_string)
+        folder_path = args.path
     else:
         print("File/folder not found: " + args.path)
+        exit(1)
+
+    # Files outside the timeframe are moved to this folder.
+    not_folder_path = os.path.join(os.path.realpath(folder_path), "not")
+    os.makedirs(not_folder_path, exist_ok=True)
 
-    outputHeadersFile.close()
+    output_file = args.output
+    if not output_file:
+        output_file = os.path.join(folder_path, "headers.1b")
 
+    # Headers are small, a large buffer collects them into few writes.
+    with open(output_file, "wb", buffering=4 * 1024 * 1024) as headers_filehandle:
+        if len(mkv_files) == 1:
+            header = scanMKVfile(mkv_files[0], carve_string, not_folder_path)
+            if header:
+                headers_filehandle.write(header)
+        else:
+            # Scan the files in parallel. Headers are written here, in file order, so they don't interleave.
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                scan = functools.partial(scanMKVfile, carve_string=carve_string, not_folder_path=not_folder_path)
+                for header in executor.map(scan, mkv_files, chunksize=16):
+                    if header:
+                        headers_filehandle.write(header)
@@ -11,30 +11,41 @@
 
 
 import argparse
+import collections
+import mmap
 import os
 import re
 import struct
-from datetime import datetime
+import time
 
 
 # Global variables
-haystack_length = 1024
-haystack_length_extra = 32
+# Search the image in tiles of a size that stays in the CPU cache.
+# The extra bytes overlap the next tile so indexes on the border are found.
+haystack_length = 2 * 1024 * 1024
+haystack_length_extra = 2048
+# Output files are copied from the image in blocks of this size.
+copy_block_length = 1024 * 1024
 file_signature = b'avfs'
 file_signature_offset = 4
 
 index_signature = b'rcfc'
 index_signature_offset = 4
-index_carve_string = b'.{4}rcfc.*tkfh.{6}<TIMEFRAME>'
+index_carve_string = b'.{4}rcfc.{0,1024}tkfh.{6}<TIMEFRAME>'
 index_at_modulo_bytes = 512
 index_date_signature = b'tkfh'
 index_date_offset = 10
+# Max distance from the start of a carve match to the date signature, and from the signature to the end.
+index_carve_before_date = 1280
+index_carve_after_date = 256
 
 index_frame_signature = b'\x12'
 index_frame_signature_offset = 0
 index_frame_footer_length = 2
 
-index_frame_carve_string = b'\x12.\x08.\x10.{1,8}\x18.{1,8}\x30\x65\x38\x00\x40\x00.*tkfc.{4}tkfh.{6}<TIMEFRAME>'
+index_frame_carve_string = b'\x12.\x08.\x10.{1,8}\x18.{1,8}\x30\x65\x38\x00\x40\x00.{0,1024}tkfc.{4}tkfh.{6}<TIMEFRAME>'
+# Literal part of index_frame_carve_string, used to skip the regex where it can't match.
+index_frame_carve_literal = b'\x30\x65\x38\x00\x40\x00'
 index_frame_size_offset = 5
 index_frame_offset_signature = b'\x18'
 
@@ -42,7 +53,14 @@ frame_signature = b'datp'
 frame_signature_offset = 4
 frame_header_length = 32
 
+# Compiled patterns, set by readTimeframe()
+index_frame_carve_re = None
+haystack_carve_re = None
+index_date_re = re.compile(index_date_signature)
+index_frame_offset_re = re.compile(index_frame_offset_signature)
+
 filehandle = None
+image_map = None
 total_size = 0
 output_writer = None
 
@@ -66,8 +84,8 @@ class OutputWriter:
             filename = f'{self.from_date}-{self.to_date}_{self.frame_count}_{self.file_start}_{self.file_end}.avd'
             output_file = os.path.join(self.out_path, filename)
             print(output_file)
-            with open(output_file, 'wb') as f:
-                f.write(readFromImage(self.file_start, (self.file_end - self.file_start)))
+            with open(output_file, 'wb', buffering=0) as f:
+                copyFromImage(f, self.file_start, (self.file_end - self.file_start))
 
         self.frame_count = 0
         self.from_date = None
@@ -103,32 +121,75 @@ class OutputWriter:
 def getBytesFromString(string):
     # Returns a string converted to bytes. Hex-values converted, but not other characters.
     # Example: "[\x41-\x5A]" =>b'[A-Z]'
-    result_bytes = b''
-    i = 0
-    while i < len(string):
-        if string[i] == "\\" and i + 4 <= len(string):
-            result_bytes += bytes.fromhex(string[i+2:i+4])
-            i += 4
-        else:
-            result_bytes += bytes(string[i], 'utf-8')
-            i += 1
-    return result_bytes
+    return re.sub(rb'\\x([0-9A-Fa-f]{2})', lambda match: bytes.fromhex(match.group(1).decode()), string.encode('utf-8'))
 
 
 def readFromImage(offset, size):
     if offset < 0:
         return None
+    if image_map is not None:
+        return image_map[offset: offset + size]
     filehandle.seek(offset)
     return filehandle.read(size)
 
 
-def regexFindInBytes(data, carve_string):
-    if carve_string:
-        carve_list = [match.start() for match in re.finditer(carve_string, data, flags=re.DOTALL)]
+def prefetchImage(offset, size):
+    # Asks the kernel to read ahead a part of a memory mapped image, while the current haystack is searched.
+    if image_map is None or not hasattr(mmap, 'MADV_WILLNEED') or offset >= total_size:
+        return
+    start = (offset // mmap.PAGESIZE) * mmap.PAGESIZE
+    image_map.madvise(mmap.MADV_WILLNEED, start, min(offset + size, total_size) - start)
+
+
+def copyFromImage(output_filehandle, offset, size):
+    # Copies a part of the image to an output file, a block at a time.
+    # RAW images are copied in the kernel with copy_file_range or sendfile, without reading the data into Python.
+    end = offset + size
+    while offset < end:
+        block_end = min(offset + copy_block_length, end)
+        if image_map is None:
+            copied = output_filehandle.write(readFromImage(offset, block_end - offset))
+        else:
+            try:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(filehandle.fileno(), output_filehandle.fileno(), end - offset, offset)
+                else:
+                    copied = os.sendfile(output_filehandle.fileno(), filehandle.fileno(), offset, end - offset)
+            except (AttributeError, OSError):
+                # Not supported on this platform or between these files, for example across file systems. Write from the memory map.
+                copied = output_filehandle.write(image_map[offset: block_end])
+        if not copied:
+            break
+        offset += copied
+
+
+def regexFindInBytes(data, carve_re, pos=0, endpos=None):
+    # Returns the match offsets relative to pos. With pos and endpos only a window of data is searched.
+    if carve_re:
+        if endpos is None:
+            endpos = len(data)
+        carve_list = [match.start() - pos for match in carve_re.finditer(data, pos, endpos)]
         return carve_list
     return []
 
 
+def carveNearDateSignature(haystack, start, end):
+    # Returns the index hits relative to start.
+    # Both carve strings contain the date signature, the regex only runs close to a signature found with find().
+    date_offset = haystack.find(index_date_signature, start, end)
+    while date_offset >= 0:
+        window_start = max(start, date_offset - index_carve_before_date)
+        window_end = min(end, date_offset + index_carve_after_date)
+        # A match has the index signature or the index frame literal before the date signature.
+        if haystack.find(index_signature, window_start, date_offset) >= 0 or \
+                haystack.find(index_frame_carve_literal, window_start, date_offset) >= 0:
+            hits = regexFindInBytes(haystack, haystack_carve_re, window_start, window_end)
+            if hits:
+                return [hit + window_start - start for hit in hits]
+        date_offset = haystack.find(index_date_signature, date_offset + 1, end)
+    return []
+
+
 def getLongLongFromBytes(value):
     if value is None:
         return 0
@@ -149,16 +210,13 @@ def getByteFromBytes(value):
 
 def getLeb128FromBytes(byte_array):
     uint = 0
+    shift = 0
     if byte_array:
-        i = 0
         for byte in byte_array:
-            sign_bit = byte >> 7
-            byte = byte & 0x7f
-            byte = byte << 7 * i
-            uint |= byte
-            if sign_bit != 0x01:
+            uint |= (byte & 0x7f) << shift
+            if byte < 0x80:
                 break
-            i += 1
+            shift += 7
     return uint
 
 
@@ -166,19 +224,17 @@ NANOSECONDS = 1000000000
 
 
 def getApfsTime(value):
+    # Returns the time as a tuple of seconds and nanoseconds since 01.01.1970.
     if value is None:
         return None
     date_long_value = getLongLongFromBytes(value)
 
-    s, ns = divmod(date_long_value, NANOSECONDS)
-    # Convert to datetime object, with remainder as microseconds.
-    date_value = datetime.utcfromtimestamp(s).replace(microsecond=(ns // 1000))
-
-    return date_value
+    return divmod(date_long_value, NANOSECONDS)
 
 
 def getDateTimeString(value):
-    return datetime.strftime(value, '%Y-%m-%d_%H%M%S')
+    s, ns = value
+    return time.strftime('%Y-%m-%d_%H%M%S', time.gmtime(s))
 
 
 def extractSizeFromFrameHeader(frame_header):
@@ -206,7 +262,7 @@ def getIndex(offset):
 
 def getDateFromIndex(found_index):
     date_value = None
-    offsets = regexFindInBytes(found_index, index_date_signature)
+    offsets = regexFindInBytes(found_index, index_date_re)
     if offsets:
         offset = offsets[0] + index_date_offset
         date_bytes = found_index[offset: offset+8]
@@ -215,27 +271,30 @@ def getDateFromIndex(found_index):
 
 
 def getFrameInfoFromIndex(found_index):
-    result = []
-    offsets = regexFindInBytes(found_index, index_frame_carve_string)
+    # Returns the offsets and sizes of the frames in the index, as two lists.
+    # The lists are in reverse order, the frame closest to the index first.
+    frame_offsets = collections.deque()
+    frame_sizes = collections.deque()
+    offsets = regexFindInBytes(found_index, index_frame_carve_re)
     if len(offsets) > 0:
         offset = offsets[0]
         while offset < len(found_index):
-            frame_bytes = found_index[offset:]
-            index_frame_field_length = getByteFromBytes(frame_bytes[1:2])
-            frame_bytes = frame_bytes[0: index_frame_field_length + index_frame_footer_length]
+            index_frame_field_length = getByteFromBytes(found_index[offset + 1: offset + 2])
+            frame_bytes = found_index[offset: offset + index_frame_field_length + index_frame_footer_length]
 
             if checkSignature(frame_bytes, index_frame_signature, index_frame_signature_offset):
                 index_frame_size = getLeb128FromBytes(frame_bytes[index_frame_size_offset:])
-                index_frame_offset_hit = regexFindInBytes(frame_bytes, index_frame_offset_signature)
+                index_frame_offset_hit = regexFindInBytes(frame_bytes, index_frame_offset_re)
                 if index_frame_offset_hit:
                     index_frame_offset = getLeb128FromBytes(frame_bytes[index_frame_offset_hit[0]+1:])
 
-                result.append({"offset": index_frame_offset, "size": index_frame_size})
+                frame_offsets.appendleft(index_frame_offset)
+                frame_sizes.appendleft(index_frame_size)
                 offset += len(frame_bytes)
             else:
                 # Reached end of index. Pattern doesn't start with index_frame_signature
                 break
-    return result
+    return frame_offsets, frame_sizes
 
 
 def isIndexSameAsFrame(index_frame_size, frame_header):
@@ -246,90 +305,102 @@ def isIndexSameAsFrame(index_frame_size, frame_header):
     return False
 
 
+def carveFromIndex(index_start):
+    # Verifies the frames of the index at index_start and updates the output writer.
+    # Returns the offset after the index.
+    found_index = getIndex(index_start)
+    index_date = getDateFromIndex(found_index)
+    index_date_string = getDateTimeString(index_date)
+    frame_offsets, frame_sizes = getFrameInfoFromIndex(found_index)
+    offset = index_start + len(found_index)
+
+    # Actual start of file. Set to currently non-overwritten part.
+    file_start = index_start
+    file_end = index_start
+    # Reference value for frames offset.
+    # If file start is not overwritten this will be equal to current_file_start
+    logical_file_start = None
+    if frame_offsets:
+        # Calculate file start from the offset to the frame closest to the index.
+        potential_file_starts = [index_start - frame_offset - frame_size
+                                 for frame_offset, frame_size in zip(frame_offsets, frame_sizes)]
+        for potential_file_start in potential_file_starts:
+            # If logical_file_start is not set, set it to potential_file_start.
+            logical_file_start = logical_file_start or potential_file_start
+
+            if potential_file_start >= 0:
+                file_start_bytes = readFromImage(potential_file_start, file_signature_offset + len(file_signature))
+                if checkSignature(file_start_bytes, file_signature, file_signature_offset):
+                    logical_file_start = potential_file_start
+                    break
+
+        # Verify the frames the index is pointing to.
+        for index_frame_offset, index_frame_size in zip(frame_offsets, frame_sizes):
+            # Test offset from logical_file_st art, since the start of file might be overwritten.
+            frame_offset = logical_file_start + index_frame_offset
+            frame_header = readFromImage(frame_offset, frame_header_length)
+            if isIndexSameAsFrame(index_frame_size, frame_header):
+                if frame_offset < file_start:
+                    # Move the file_start to the earliest point of carved bytes.
+                    file_start = frame_offset
+
+                file_end = offset
+                output_writer.setDate(index_date_string)
+                output_writer.increaseFrameCount()
+            else:
+                print("Couldn't find frame @" + str(frame_offset) + ": " + str(index_frame_offset))
+                break
+    output_writer.setFileStartEnd(file_start, file_end)
+    return offset
+
+
 def searchChunksOfData(resume):
 
     offset = resume
 
     progress_report = total_size / 100
     next_progress_report = offset
-    log_offset_counter = 0
-    log_offset_to_file = 200000
-
-    current_index = []
+    log_offset_to_file = 200 * 1024 * 1024
+    next_offset_to_file = offset + log_offset_to_file
 
     while offset < total_size:
-        log_offset_counter += 1
-        if log_offset_counter > log_offset_to_file:
-            log_offset_counter = 0
+        if offset >= next_offset_to_file:
             output_writer.writeLog(str(offset))
+            next_offset_to_file = offset + log_offset_to_file
 
         if offset >= next_progress_report:
             print("Searching... " + str(100 * offset // total_size) + "% Current offset: " + str(
                 offset) + " / " + str(total_size))
             next_progress_report = next_progress_report + progress_report
 
-        haystack = readFromImage(offset, haystack_length + haystack_length_extra)
-        index_hits = regexFindInBytes(haystack, index_carve_string)
-        if len(index_hits) == 0:
-            index_hits = regexFindInBytes(haystack, index_frame_carve_string)
-        if len(index_hits) > 0:
-            offset += index_hits[0]
+        # Load one tile of the image, and search it for all indexes before moving to the next tile.
+        tile_offset = offset
+        if image_map is not None:
+            # Search the memory mapped image directly, without copying the haystack.
+            haystack = image_map
+            haystack_start = tile_offset
+            prefetchImage(tile_offset + haystack_length + haystack_length_extra, haystack_length)
+        else:
+            haystack = readFromImage(tile_offset, haystack_length + haystack_length_extra)
+            haystack_start = 0
+        haystack_end = haystack_start + haystack_length + haystack_length_extra
+
+        search_start = haystack_start
+        while search_start < haystack_end:
+            index_hits = carveNearDateSignature(haystack, search_start, haystack_end)
+            if len(index_hits) == 0:
+                break
+            hit_offset = tile_offset + (search_start - haystack_start) + index_hits[0]
 
             # Index starts at start of cluster or sector
-            offset = (offset // index_at_modulo_bytes) * index_at_modulo_bytes
-
-            found_index = getIndex(offset)
-            index_start = offset
-            index_date = getDateFromIndex(found_index)
-            index_date_string = getDateTimeString(index_date)
-            current_index += getFrameInfoFromIndex(found_index)
-            offset += len(found_index)
-
-            # Actual start of file. Set to currently non-overwritten part.
-            file_start = index_start
-            file_end = index_start
-            # Reference value for frames offset.
-            # If file start is not overwritten this will be equal to current_file_start
-            logical_file_start = None
-            if current_index:
-                # Reverse the list to read the frames closest to the index first.
-                current_index.reverse()
-
-                # Calculate file start from the offset to the frame closest to the index.
-                for index in current_index:
-                    potential_file_start = index_start - index["offset"] - index["size"]
-
-                    # If logical_file_start is not set, set it to potential_file_start.
-                    logical_file_start = logical_file_start or potential_file_start
-
-                    if potential_file_start >= 0:
-                        file_start_bytes = readFromImage(potential_file_start, file_signature_offset + len(file_signature))
-                        if checkSignature(file_start_bytes, file_signature, file_signature_offset):
-                            logical_file_start = potential_file_start
-                            break
-
-                # Verify the frames the index is pointing to.
-                for index in current_index:
-                    # Test offset from logical_file_st art, since the start of file might be overwritten.
-                    frame_offset = logical_file_start + index["offset"]
-                    frame_header = readFromImage(frame_offset, frame_header_length)
-                    if isIndexSameAsFrame(index["size"], frame_header):
-                        if frame_offset < file_start:
-                            # Move the file_start to the earliest point of carved bytes.
-                            file_start = frame_offset
-
-                        file_end = offset
-                        output_writer.setDate(index_date_string)
-                        output_writer.increaseFrameCount()
-                    else:
-                        print("Couldn't find frame @" + str(frame_offset) + ": " + str(index["offset"]))
-                        break
-            current_index = []
-            output_writer.setFileStartEnd(file_start, file_end)
+            offset = (hit_offset // index_at_modulo_bytes) * index_at_modulo_bytes
+            offset = carveFromIndex(offset)
 
-        else:
+            # Continue the search in the tile after the index, and never before the hit.
+            offset = max(offset, hit_offset + 1)
+            search_start = haystack_start + (offset - tile_offset)
 
-            offset = offset + haystack_length
+        offset = max(offset, tile_offset + haystack_length)
 
     output_writer.saveToFile()
 
@@ -348,15 +419,21 @@ def parseArguments():
 
 
 def readTimeframe(timeframe):
-    global index_carve_string, index_frame_carve_string
+    global index_carve_string, index_frame_carve_string, index_frame_carve_re, haystack_carve_re
 
-    date_regex = getBytesFromString(timeframe)
+    # Group the timeframe, so alternations in it don't split the carve strings.
+    date_regex = b'(?:' + getBytesFromString(timeframe) + b')'
     index_carve_string = index_carve_string.replace(b'<TIMEFRAME>', date_regex)
     index_frame_carve_string = index_frame_carve_string.replace(b'<TIMEFRAME>', date_regex)
 
+    # Compile once, the patterns are used for every haystack.
+    # The haystack is searched for both indexes and index frames in a single pass.
+    index_frame_carve_re = re.compile(index_frame_carve_string, re.DOTALL)
+    haystack_carve_re = re.compile(b'(?:' + index_carve_string + b')|(?:' + index_frame_carve_string + b')', re.DOTALL)
+
 
 def openImageFile(filename):
-    global filehandle, total_size
+    global filehandle, image_map, total_size
 
     if not os.path.isfile(filename):
         print("File not found: " + filename)
@@ -376,6 +453,11 @@ def openImageFile(filename):
     else:
         filehandle = open(filename, 'rb')
         total_size = os.fstat(filehandle.fileno()).st_size
+        if total_size > 0:
+            # Memory map RAW images, reads are then slices of the map instead of seek and read.
+            image_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                image_map.madvise(mmap.MADV_SEQUENTIAL)
 
 
 def createOutputWriter(output, filename):
@@ -8,6 +8,7 @@
 
 import argparse
 import glob
+import mmap
 import os
 import struct
 
@@ -17,15 +18,6 @@ frame_header_length = 32
 OFFSET_SKIP = 512
 
 
-def readFromFile(filehandle, size, offset):
-    filehandle.seek(offset)
-    return filehandle.read(size)
-
-
-def hasBlockSignature(header):
-    return header[frame_signature_offset : frame_signature_offset + len(frame_signature)] == frame_signature
-
-
 def getLongBigEndian(value):
     return struct.unpack(">L", value)[0]
 
@@ -35,33 +27,44 @@ def extractBodySize(header):
     return getLongBigEndian(body_size_data)
 
 
-def saveBodyToFile(file_path, filehandle, start_offset, body_size):
-    with open(file_path, 'ab') as f:
-        f.write(readFromFile(filehandle, body_size, start_offset))
+def saveBodyToFile(output_filehandle, file_map, start_offset, body_size):
+    output_filehandle.write(file_map[start_offset: start_offset + body_size])
 
 
-def searchChunksOfData(filehandle, total_size, output_file):
-    offset = 0
+def searchChunksOfData(file_map, total_size, output_file_path):
     block_seq = 0
-
-    while offset + frame_header_length < total_size:
-        header = readFromFile(filehandle, frame_header_length, offset)
-
-        if hasBlockSignature(header):
-            block_seq += 1
-            body_size = extractBodySize(header)
-
-            # Save the body to file
-            saveBodyToFile(output_file, filehandle, offset + frame_header_length, body_size)
-            # Save the header
-            #saveBodyToFile(output_file + ".headers", filehandle, offset, frame_header_length)
-
-        offset = offset + OFFSET_SKIP
+    # The output file is opened at the first frame, the body of every frame is appended to it.
+    output_filehandle = None
+
+    try:
+        # Jump between frame signatures with find(), frame headers are only valid at every OFFSET_SKIP bytes.
+        signature_offset = file_map.find(frame_signature)
+        while signature_offset >= 0:
+            offset = signature_offset - frame_signature_offset
+            if offset + frame_header_length >= total_size:
+                break
+
+            if offset % OFFSET_SKIP == 0:
+                block_seq += 1
+                body_size = extractBodySize(file_map[offset: offset + frame_header_length])
+
+                # Save the body to file
+                if output_filehandle is None:
+                    output_filehandle = open(output_file_path, 'wb')
+                saveBodyToFile(output_filehandle, file_map, offset + frame_header_length, body_size)
+                next_offset = offset + OFFSET_SKIP
+            else:
+                next_offset = offset + 1
+
+            signature_offset = file_map.find(frame_signature, next_offset + frame_signature_offset)
+    finally:
+        if output_filehandle is not None:
+            output_filehandle.close()
 
     if block_seq > 0:
         # Create a summary for the user.
         result_text = "Frames: " + str(block_seq) + os.linesep
-        result_text += "File saved: " + output_file + os.linesep
+        result_text += "File saved: " + output_file_path + os.linesep
         result_text += "The videodata is not correctly stored in a mpeg4-container." + os.linesep
         result_text += "Recomended videoplayer: ffplay " + os.linesep
         print(result_text)
@@ -75,6 +78,12 @@ def extractDataFromFile(dvr_file_path, output_path):
     filehandle = open(dvr_file_path, 'rb')
     total_size = os.fstat(filehandle.fileno()).st_size
     print("Success.")
+    if total_size <= frame_header_length:
+        return
+
+    file_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        file_map.madvise(mmap.MADV_SEQUENTIAL)
 
     if not output_path:
         output_path = os.path.join(folder_path, "output")
@@ -84,7 +93,7 @@ def extractDataFromFile(dvr_file_path, output_path):
     # Base for file or folders are 'output/dvrfile_yyyy-mm-dd_hhmmss-hhmmss'
     output_file_path = os.path.join(output_path, dvr_file + ".avigilon")
 
-    searchChunksOfData(filehandle, total_size, output_file_path)
+    searchChunksOfData(file_map, total_size, output_file_path)
 
 
 if __name__ == '__main__':
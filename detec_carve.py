@@ -10,24 +10,49 @@
 # Version: 0.1
 
 import argparse
+import collections
+import mmap
 import os
+import queue
 import re
 import struct
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 # Global variables
-haystack_length = 1024
-
-frame_signature = "\xFF\xFF\xFF\xFF"
+# Search the image in large chunks, each read overlaps the next chunk by the length of the carve string.
+haystack_length = 8 * 1024 * 1024
+# The part of the image further back than this is dropped from the page cache while scanning.
+release_behind_length = 16 * 1024 * 1024
+# The image is released from the cache up to this offset.
+released_until = 0
+# Number of chunks the background reader may read ahead of the search.
+read_ahead_chunks = 4
+# Output files are copied from the image in blocks of this size.
+copy_block_length = 1024 * 1024
+# RAW images are split into ranges of this size, searched by one worker process each.
+range_length = 64 * 1024 * 1024
+# Ranges submitted to the workers ahead of the scan, more would only hold their frames in memory.
+ranges_in_flight = 2 * (os.cpu_count() or 1)
+
+frame_signature = b"\xFF\xFF\xFF\xFF"
+# The frame date (ticks) is the 8 bytes before the signature, these are matched against the timeframe.
 frame_signature_offset = 8
-frame_carve_string = b"<TIMEFRAME>\xFF\xFF\xFF\xFF"
 
 frame_header_length = 28
-frame_header_date = 0
-frame_header_size = 24
+# Frame header: date as ticks at offset 0 and frame size at offset 24.
+frame_header_struct = struct.Struct('<Q16xI')
 frame_footer_length = 20
 
+# Compiled timeframe, set by parseArguments()
+timeframe_re = None
+# Each chunk is read with this overlap into the next chunk, enough for a frame header.
+chunk_overlap_length = frame_header_length
+
 filehandle = None
+image_map = None
+image_lock = threading.Lock()
 total_size = 0
 output_writer = None
 
@@ -41,30 +66,39 @@ class OutputWriter:
         self.out_suffix = suffix
         self.file_start = 0
         self.file_end = 0
-        self.from_date = ""
-        self.to_date = ""
+        # Dates are kept as ticks, and only formatted when a file is saved.
+        self.from_date = None
+        self.to_date = None
         self.frame_count = 0
 
         if not os.path.exists(self.out_path):
             os.makedirs(self.out_path)
 
         self.log_file = os.path.join(self.out_path, "currentOffset.log")
+        self.log_filehandle = None
 
     def saveToFile(self):
         if self.frame_count > 0 and self.file_end > self.file_start:
-            filename = f'{self.out_prefix}{self.from_date}-{self.to_date[11:17]}_{self.frame_count}_{self.file_start}_{self.file_end}{self.out_suffix}'
+            from_date = getDateTimeString(getTicksTime(self.from_date))
+            to_date = getDateTimeString(getTicksTime(self.to_date))
+            filename = f'{self.out_prefix}{from_date}-{to_date[11:17]}_{self.frame_count}_{self.file_start}_{self.file_end}{self.out_suffix}'
             output_file = os.path.join(self.out_path, filename)
             print(output_file)
-            with open(output_file, 'wb') as f:
-                f.write(readFromImage(self.file_start, (self.file_end - self.file_start)))
+            with open(output_file, 'wb', buffering=0) as f:
+                copyFromImage(f, self.file_start, (self.file_end - self.file_start))
 
         self.frame_count = 0
         self.from_date = None
         self.to_date = None
 
     def writeLog(self, logline):
-        with open(self.log_file, 'w') as f:
-            f.write(logline)
+        # The log is opened once, and overwritten for every new line.
+        if self.log_filehandle is None:
+            self.log_filehandle = open(self.log_file, 'w')
+        self.log_filehandle.seek(0)
+        self.log_filehandle.write(logline)
+        self.log_filehandle.truncate()
+        self.log_filehandle.flush()
 
     def setFileStartEnd(self, start, end):
         if start <= self.file_start:
@@ -85,7 +119,7 @@ class OutputWriter:
         self.frame_count += 1
 
     def setDate(self, date):
-        if not self.from_date:
+        if self.from_date is None:
             self.from_date = date
         self.to_date = date
 
@@ -93,35 +127,110 @@ class OutputWriter:
 def getBytesFromString(string):
     # Returns a string converted to bytes. Hex-values converted, but not other characters.
     # Example: "[\x41-\x5A]" =>b'[A-Z]'
-    result_bytes = b''
-    i = 0
-    while i < len(string):
-        if string[i] == "\\" and i + 4 <= len(string):
-            result_bytes += bytes.fromhex(string[i+2:i+4])
-            i += 4
-        else:
-            result_bytes += bytes(string[i], 'utf-8')
-            i += 1
-    return result_bytes
+    return re.sub(rb'\\x([0-9A-Fa-f]{2})', lambda match: bytes.fromhex(match.group(1).decode()), string.encode('utf-8'))
 
 
 def readFromImage(offset, size):
     if offset < 0:
         return None
-    filehandle.seek(offset)
-    return filehandle.read(size)
-
-
-def carveInImage(offset, size, carve_string):
-    result = []
-    # Return empty if there is nothing to search for
-    if not carve_string:
-        return result
-
-    data = readFromImage(offset, size + len(carve_string))
+    if image_map is not None:
+        return image_map[offset: offset + size]
+    # The background reader shares the filehandle, seek and read must not be interleaved.
+    with image_lock:
+        filehandle.seek(offset)
+        return filehandle.read(size)
+
+
+def prefetchImage(offset, size):
+    # Asks the kernel to read ahead a part of a memory mapped image, while the current chunk is searched.
+    if image_map is None or not hasattr(mmap, 'MADV_WILLNEED') or offset >= total_size:
+        return
+    start = (offset // mmap.PAGESIZE) * mmap.PAGESIZE
+    image_map.madvise(mmap.MADV_WILLNEED, start, min(offset + size, total_size) - start)
+
+
+def readChunksInBackground(offset, size):
+    # Reads chunks of the image in a background thread, so the next chunks are read while one is searched.
+    # Yields the data of each chunk, including the overlap into the next chunk.
+    chunk_queue = queue.Queue(maxsize=read_ahead_chunks)
+
+    def readChunks():
+        # A read error is passed on to the searching thread, which would otherwise wait for the next chunk forever.
+        try:
+            for chunk_offset in range(offset, total_size, size):
+                chunk_queue.put(readFromImage(chunk_offset, size + chunk_overlap_length))
+        except BaseException as e:
+            chunk_queue.put(e)
+        finally:
+            chunk_queue.put(None)
+
+    threading.Thread(target=readChunks, daemon=True).start()
+    data = chunk_queue.get()
+    while data is not None:
+        if isinstance(data, BaseException):
+            raise data
+        yield data
+        data = chunk_queue.get()
+
+
+def copyFromImage(output_filehandle, offset, size):
+    # Copies a part of the image to an output file, a block at a time.
+    # RAW images are copied in the kernel with copy_file_range or sendfile, without reading the data into Python.
+    end = offset + size
+    while offset < end:
+        block_end = min(offset + copy_block_length, end)
+        if image_map is None:
+            copied = output_filehandle.write(readFromImage(offset, block_end - offset))
+        else:
+            try:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(filehandle.fileno(), output_filehandle.fileno(), end - offset, offset)
+                else:
+                    copied = os.sendfile(output_filehandle.fileno(), filehandle.fileno(), offset, end - offset)
+            except (AttributeError, OSError):
+                # Not supported on this platform or between these files, for example across file systems. Write from the memory map.
+                copied = output_filehandle.write(image_map[offset: block_end])
+        if not copied:
+            break
+        offset += copied
+
+
+def releaseScannedImage(offset):
+    # Tells the kernel that the scanned part of a RAW image will not be read again soon.
+    # The pages are unmapped first, the kernel doesn't drop pages from the cache while they are mapped.
+    # Frames saved later are read from disk again, only the cache is affected.
+    global released_until
+    release_end = (offset - release_behind_length) // mmap.PAGESIZE * mmap.PAGESIZE
+    if image_map is None or release_end <= released_until:
+        return
+    if hasattr(mmap, 'MADV_DONTNEED'):
+        image_map.madvise(mmap.MADV_DONTNEED, released_until, release_end - released_until)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(filehandle.fileno(), released_until, release_end - released_until, os.POSIX_FADV_DONTNEED)
+    released_until = release_end
+
+
+def carveInImage(offset, size, data=None):
+    # Yields the offsets of frames within timeframe, relative to offset.
+    # Memory mapped images are searched in place, other images are read into a buffer if not already read.
+    if data is None and image_map is not None:
+        data = image_map
+        start = offset
+        end = min(offset + size + chunk_overlap_length, total_size)
+    else:
+        if data is None:
+            data = readFromImage(offset, size + chunk_overlap_length)
+        start = 0
+        end = len(data)
 
-    result = [match.start() for match in re.finditer(carve_string, data, flags=re.DOTALL)]
-    return result
+    # Find the fixed frame signature first, and only match the date before it against the timeframe.
+    # Frames starting in the overlap are left to the next chunk.
+    signature_offset = data.find(frame_signature, start, end)
+    while 0 <= signature_offset < start + size + frame_signature_offset:
+        frame_start = signature_offset - frame_signature_offset
+        if frame_start >= start and timeframe_re.fullmatch(data, frame_start, signature_offset):
+            yield frame_start - start
+        signature_offset = data.find(frame_signature, signature_offset + 1, end)
 
 
 # 01.01.1970 in Microsoft Ticks (LE) : 0080B5F7F57F9F08 = 621355968000000000
@@ -129,34 +238,18 @@ EPOCH_AS_TICKS_TIME = 621355968000000000  # January 1, 1970 as ticks
 HUNDREDS_OF_NS = 10000000
 
 
-def getTicksTime(value):
-    if value is None:
+def getTicksTime(date_long_value):
+    if date_long_value is None:
         return None
-    date_long_value = getLongLongFromBytes(value)
 
     # Code from https://github.com/jleclanche/winfiletime Because pip winfiletime contains an error.
-    # Get seconds and remainder in terms of Unix epoch
-    s, ns100 = divmod(date_long_value - EPOCH_AS_TICKS_TIME, HUNDREDS_OF_NS)
-    # Convert to datetime object, with remainder as microseconds.
-    date_value = datetime.utcfromtimestamp(s).replace(microsecond=(ns100 // 10))
-
-    return date_value
-
-
-def getLongLongFromBytes(value):
-    if value is None:
-        return 0
-    return struct.unpack('<Q', value)[0]
-
-
-def getIntFromBytes(value):
-    if value is None:
-        return 0
-    return struct.unpack('<I', value)[0]
+    # Returns the time as a tuple of seconds and remainder (100 ns) since 01.01.1970.
+    return divmod(date_long_value - EPOCH_AS_TICKS_TIME, HUNDREDS_OF_NS)
 
 
 def getDateTimeString(value):
-    return datetime.strftime(value, '%Y-%m-%d_%H%M%S')
+    s, ns100 = value
+    return time.strftime('%Y-%m-%d_%H%M%S', time.gmtime(s))
 
 
 def searchChunksOfData():
@@ -164,44 +257,149 @@ def searchChunksOfData():
 
     progress_report = total_size / 100
     next_progress_report = offset
-    next_offset_to_file = offset
-    log_offset_to_file = 200000
+    log_offset_to_file = 64 * 1024 * 1024
+    next_offset_to_file = offset + log_offset_to_file
+
+    # The next frame can not start before the end of the last frame found.
+    skip_until = offset
+
+    # Memory mapped images are prefetched by the kernel, other images are read ahead in a thread.
+    chunks = None
+    if image_map is None:
+        chunks = readChunksInBackground(offset, haystack_length)
 
     while offset < total_size:
         # Write offset to file, makes it easier to resume
-        if offset >= log_offset_to_file:
+        if offset >= next_offset_to_file:
             output_writer.writeLog(str(offset))
-            next_offset_to_file += log_offset_to_file
+            next_offset_to_file = offset + log_offset_to_file
 
         # Write progress report to console
         if offset >= next_progress_report:
             print("Searching... " + str(100 * offset // total_size) + "% Current offset: " + str(offset) + " / " + str(total_size))
             next_progress_report += progress_report
 
-        # Search for frames.
-        hits = carveInImage(offset, haystack_length, frame_carve_string)
-        if len(hits) > 0:
-            for hit in hits:
-                # Frame found, get info from header.
-                frame_start = offset + hit
-                frame_header = readFromImage(frame_start, frame_header_length)
-                date_from_ticks = getTicksTime(frame_header[frame_header_date: frame_header_date + 8])
-                frame_date = getDateTimeString(date_from_ticks)
-                frame_size = getIntFromBytes(frame_header[frame_header_size: frame_header_size + 4])
-                frame_end = frame_start + frame_header_length + frame_size + frame_footer_length
-                # Update info to output writer. setFileStartEnd() writes to file if there is no contiguous file.
+        # Search for frames. A chunk that is entirely within the last frame found is not searched.
+        data = None
+        if chunks is not None:
+            data = next(chunks)
+            hits = carveInImage(offset, haystack_length, data) if offset + haystack_length > skip_until else []
+        elif offset + haystack_length > skip_until:
+            prefetchImage(offset + haystack_length, haystack_length)
+            hits = carveInImage(offset, haystack_length)
+        else:
+            hits = []
+        for hit in hits:
+            # Frame found, skip it if it is within the body of the last frame found.
+            frame_start = offset + hit
+            if frame_start < skip_until:
+                continue
+            # Headers are unpacked from the chunk already read, or directly from the memory map.
+            if data is not None:
+                frame_ticks, frame_size = frame_header_struct.unpack_from(data, hit)
+            elif image_map is not None:
+                frame_ticks, frame_size = frame_header_struct.unpack_from(image_map, frame_start)
+            else:
+                frame_ticks, frame_size = frame_header_struct.unpack(readFromImage(frame_start, frame_header_length))
+            frame_end = frame_start + frame_header_length + frame_size + frame_footer_length
+            # Update info to output writer. setFileStartEnd() writes to file if there is no contiguous file.
+            output_writer.setFileStartEnd(frame_start, frame_end)
+            output_writer.setDate(frame_ticks)
+            output_writer.increaseFrameCount()
+            skip_until = frame_end
+
+        offset = offset + haystack_length
+        releaseScannedImage(offset)
+
+    # Write out the last frame.
+    output_writer.saveToFile()
+
+
+def initWorker(filename, timeframe):
+    # Sets up a worker process with the timeframe and its own memory map of the image.
+    global timeframe_re, filehandle, image_map, total_size
+    timeframe_re = re.compile(timeframe, re.DOTALL)
+
+    filehandle = open(filename, 'rb')
+    total_size = os.fstat(filehandle.fileno()).st_size
+    image_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        image_map.madvise(mmap.MADV_SEQUENTIAL)
+
+
+def carveFramesInRange(start):
+    # Returns (frame_start, frame_end, frame_ticks) for every frame starting within a range of a memory mapped image.
+    frames = []
+    end = min(start + range_length, total_size)
+    offset = start
+    while offset < end:
+        size = min(haystack_length, end - offset)
+        prefetchImage(offset + size, haystack_length)
+        for hit in carveInImage(offset, size):
+            frame_start = offset + hit
+            frame_ticks, frame_size = frame_header_struct.unpack_from(image_map, frame_start)
+            frames.append((frame_start, frame_start + frame_header_length + frame_size + frame_footer_length, frame_ticks))
+        offset += size
+
+    # Unmap the searched range, so releaseScannedImage() in the main process can drop it from the cache.
+    if hasattr(mmap, 'MADV_DONTNEED'):
+        release_start = start // mmap.PAGESIZE * mmap.PAGESIZE
+        image_map.madvise(mmap.MADV_DONTNEED, release_start, end - release_start)
+    return frames
+
+
+def getRangeResults(executor, range_starts):
+    # Yields the results of carveFramesInRange() in image order.
+    # Only ranges_in_flight ranges are submitted at a time, so the workers don't run far ahead of the scan.
+    futures = collections.deque()
+    for range_start in range_starts:
+        futures.append(executor.submit(carveFramesInRange, range_start))
+        if len(futures) >= ranges_in_flight:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def searchRangesInParallel(filename):
+    # Searches ranges of a memory mapped image in worker processes.
+    # The frames are handled here in image order, so the output is the same as from searchChunksOfData().
+    offset = resume_offset
+
+    progress_report = total_size / 100
+    next_progress_report = offset
+
+    # The next frame can not start before the end of the last frame found.
+    skip_until = offset
+
+    range_starts = range(offset, total_size, range_length)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=initWorker,
+                             initargs=(filename, timeframe_re.pattern)) as executor:
+        for range_start, frames in zip(range_starts, getRangeResults(executor, range_starts)):
+            # Write progress report to console
+            if range_start >= next_progress_report:
+                print("Searching... " + str(100 * range_start // total_size) + "% Current offset: " + str(range_start) + " / " + str(total_size))
+                next_progress_report += progress_report
+
+            for frame_start, frame_end, frame_ticks in frames:
+                # Skip frames within the body of the last frame found.
+                if frame_start < skip_until:
+                    continue
                 output_writer.setFileStartEnd(frame_start, frame_end)
-                output_writer.setDate(frame_date)
+                output_writer.setDate(frame_ticks)
                 output_writer.increaseFrameCount()
+                skip_until = frame_end
 
-        offset = offset + haystack_length
+            # Write offset to file, makes it easier to resume
+            range_end = min(range_start + range_length, total_size)
+            output_writer.writeLog(str(range_end))
+            releaseScannedImage(range_end)
 
     # Write out the last frame.
     output_writer.saveToFile()
 
 
 def parseArguments():
-    global frame_carve_string
+    global timeframe_re
     parser = argparse.ArgumentParser(description='Scans image-files (RAW or EWF) for video files within a timeframe. '
                                                  'Video files from Detec video surveillance system. '
                                                  'Searches for frames within timeframe and tries recover as much as possible of video data.')
@@ -212,14 +410,14 @@ def parseArguments():
     parser.add_argument('-r', '--resume', type=int, help='Resume from offset.')
     arguments = parser.parse_args()
 
-    date_regex = getBytesFromString(arguments.timeframe)
-    frame_carve_string = frame_carve_string.replace(b'<TIMEFRAME>', date_regex)
+    # DOTALL, a '.' in the timeframe must match any byte of the date.
+    timeframe_re = re.compile(getBytesFromString(arguments.timeframe), re.DOTALL)
 
     return arguments
 
 
 def openImageFile(filename):
-    global filehandle, total_size
+    global filehandle, image_map, total_size
 
     if not os.path.isfile(filename):
         print("File not found: " + filename)
@@ -239,6 +437,13 @@ def openImageFile(filename):
     else:
         filehandle = open(filename, 'rb')
         total_size = os.fstat(filehandle.fileno()).st_size
+        if total_size > 0:
+            # Memory map RAW images, reads are then slices of the map instead of seek and read.
+            image_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                image_map.madvise(mmap.MADV_SEQUENTIAL)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(filehandle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
 
 def createOutputWriter(output, filename):
@@ -260,4 +465,8 @@ if __name__ == "__main__":
     if args.resume:
         resume_offset = args.resume
 
-    searchChunksOfData()
+    # RAW images are searched by several processes, EWF images are searched in this process.
+    if image_map is not None and (os.cpu_count() or 1) > 1:
+        searchRangesInParallel(args.filename)
+    else:
+        searchChunksOfData()
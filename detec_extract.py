@@ -8,8 +8,8 @@
 
 import argparse
 import glob
+import mmap
 import os
-import re
 import struct
 from datetime import datetime
 
@@ -25,6 +25,7 @@ frame_header_size = 24
 frame_footer_length = 20
 
 filehandle = None
+file_map = None
 total_size = 0
 output_writer = None
 
@@ -34,19 +35,33 @@ resume_offset = 0
 def readFromImage(offset, size):
     if offset < 0:
         return None
+    if file_map is not None:
+        return file_map[offset: offset + size]
     filehandle.seek(offset)
     return filehandle.read(size)
 
 
-def carveInImage(offset, size, carve_string):
+def carveInImage(offset, size, signature):
     result = []
     # Return empty if there is nothing to search for
-    if not carve_string:
+    if not signature:
         return result
 
-    data = readFromImage(offset, size + len(carve_string))
-
-    result = [match.start() for match in re.finditer(carve_string, data, flags=re.DOTALL)]
+    # Memory mapped files are searched in place, the overlap into the next chunk is then not copied.
+    if file_map is not None:
+        data = file_map
+        start = offset
+        end = min(offset + size + len(signature), total_size)
+    else:
+        data = readFromImage(offset, size + len(signature))
+        start = 0
+        end = len(data)
+
+    # The signature is a fixed byte string, find() is enough.
+    hit = data.find(signature, start, end)
+    while hit >= 0:
+        result.append(hit - start)
+        hit = data.find(signature, hit + len(signature), end)
     return result
 
 
@@ -56,36 +71,43 @@ def getIntFromBytes(value):
     return struct.unpack('<I', value)[0]
 
 
-def saveBodyToFile(file_path, start_offset, body_size):
-    with open(file_path, 'ab') as f:
-        f.write(readFromImage(start_offset, body_size))
+def saveBodyToFile(output_filehandle, start_offset, body_size):
+    output_filehandle.write(readFromImage(start_offset, body_size))
 
 
-def searchChunksOfData(output_file):
+def searchChunksOfData(output_file_path):
     offset = resume_offset
-
-    while offset < total_size:
-        # Search for frames.
-        hits = carveInImage(offset, haystack_length, frame_signature)
-        if len(hits) > 0:
-            offset_skip = 0
-            for hit in hits:
-                # Frame found, get info from header.
-                frame_start = offset + hit
-                frame_header = readFromImage(frame_start, frame_header_length)
-                frame_size = getIntFromBytes(frame_header[frame_header_size: frame_header_size + 4])
-
-                # Save the body to file
-                saveBodyToFile(output_file, offset + frame_header_length, frame_size)
-
-                offset_skip += frame_header_length + frame_size
-            offset += offset_skip
-        else:
-            offset += haystack_length
+    # The output file is opened at the first frame, the body of every frame is appended to it.
+    output_filehandle = None
+
+    try:
+        while offset < total_size:
+            # Search for frames.
+            hits = carveInImage(offset, haystack_length, frame_signature)
+            if len(hits) > 0:
+                offset_skip = 0
+                for hit in hits:
+                    # Frame found, get info from header.
+                    frame_start = offset + hit
+                    frame_header = readFromImage(frame_start, frame_header_length)
+                    frame_size = getIntFromBytes(frame_header[frame_header_size: frame_header_size + 4])
+
+                    # Save the body to file
+                    if output_filehandle is None:
+                        output_filehandle = open(output_file_path, 'wb', buffering=1024 * 1024)
+                    saveBodyToFile(output_filehandle, offset + frame_header_length, frame_size)
+
+                    offset_skip += frame_header_length + frame_size
+                offset += offset_skip
+            else:
+                offset += haystack_length
+    finally:
+        if output_filehandle is not None:
+            output_filehandle.close()
 
 
 def extractDataFromFile(file_path, output_path):
-    global filehandle, total_size
+    global filehandle, file_map, total_size
     folder_path, dvr_file = os.path.split(os.path.realpath(file_path))
 
     # Open file
@@ -93,6 +115,12 @@ def extractDataFromFile(file_path, output_path):
     filehandle = open(file_path, 'rb')
     total_size = os.fstat(filehandle.fileno()).st_size
     print("Success.")
+    file_map = None
+    if total_size > 0:
+        # Memory map the file, reads are then slices of the map instead of seek and read.
+        file_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            file_map.madvise(mmap.MADV_SEQUENTIAL)
 
     if not output_path:
         output_path = os.path.join(folder_path, "output")
@@ -10,10 +10,13 @@
 # Version: 0.7
 
 import argparse
+import mmap
 import os
+import queue
 import re
 import struct
-from datetime import datetime
+import threading
+import time
 
 parser = argparse.ArgumentParser(description='Scans image-files (RAW or EWF) for video files within a timeframe.'
                                              'Video files from Milestone XProtect video surveillance system.'
@@ -43,64 +46,138 @@ if args.resume:
 def getBytesFromString(string):
     # Returns a string converted to bytes. Hex-values converted, but not other characters.
     # Example: "[\x41-\x5A]" =>b'[A-Z]'
-    result_bytes = b''
-    i = 0
-    while i < len(string):
-        if string[i] == "\\" and i + 4 <= len(string):
-            result_bytes += bytes.fromhex(string[i+2:i+4])
-            i += 4
-        else:
-            result_bytes += bytes(string[i], 'utf-8')
-            i += 1
-    return result_bytes
+    return re.sub(rb'\\x([0-9A-Fa-f]{2})', lambda match: bytes.fromhex(match.group(1).decode()), string.encode('utf-8'))
 
 
 date_regex = getBytesFromString(args.timeframe)
 
 total_size = 0
 filehandle = None
+image_map = None
 
 carve_string = "<TIMEFRAME><TIMEFRAME>.{16}<TIMEFRAME><TIMEFRAME>"
 header_length = 32
-header_date_offset = 0
-header_date_length = 8
-header_size_offset = 24
-header_size_length = 4
+# Block header: date as filetime at offset 0 and block size at offset 24.
+header_struct = struct.Struct('<Q16xL')
 carve_string_length = 48
-carve_haystack_length = 512
+# Search the image in large chunks, each read overlaps the next chunk by the length of the carve string.
+carve_haystack_length = 8 * 1024 * 1024
 
 carve_string = getBytesFromString(carve_string)
 carve_string = carve_string.replace(b'<TIMEFRAME>', date_regex)
+carve_re = re.compile(carve_string, flags=re.DOTALL)
 
 offset_skip = carve_haystack_length
 full_haystack_length = carve_haystack_length + carve_string_length
+# The part of the image further back than this is dropped from the page cache while scanning.
+release_behind_length = 16 * 1024 * 1024
+# The image is released from the cache up to this offset.
+released_until = 0
+# Number of chunks the background reader may read ahead of the search.
+read_ahead_chunks = 4
+image_lock = threading.Lock()
+# Output files are copied from the image in blocks of this size.
+copy_block_length = 1024 * 1024
 
 
 def readFromImage(size, offset):
-    filehandle.seek(offset)
-    return filehandle.read(size)
-
-
-def searchBytes(size, offset):
-    data = readFromImage(size, offset)
-    carve_list = [match.start() for match in re.finditer(carve_string, data, flags=re.DOTALL)]
-    return carve_list
+    if image_map is not None:
+        return image_map[offset: offset + size]
+    # The background reader shares the filehandle, seek and read must not be interleaved.
+    with image_lock:
+        filehandle.seek(offset)
+        return filehandle.read(size)
+
+
+def prefetchImage(size, offset):
+    # Asks the kernel to read ahead a part of a memory mapped image, while the current chunk is searched.
+    if image_map is None or not hasattr(mmap, 'MADV_WILLNEED') or offset >= total_size:
+        return
+    start = (offset // mmap.PAGESIZE) * mmap.PAGESIZE
+    image_map.madvise(mmap.MADV_WILLNEED, start, min(offset + size, total_size) - start)
+
+
+def readChunksInBackground(offset):
+    # Reads chunks of the image in a background thread, so the next chunks are read while one is searched.
+    chunk_queue = queue.Queue(maxsize=read_ahead_chunks)
+
+    def readChunks():
+        # A read error is passed on to the searching thread, which would otherwise wait for the next chunk forever.
+        try:
+            for chunk_offset in range(offset, total_size, offset_skip):
+                chunk_queue.put(readFromImage(full_haystack_length, chunk_offset))
+        except BaseException as e:
+            chunk_queue.put(e)
+        finally:
+            chunk_queue.put(None)
+
+    threading.Thread(target=readChunks, daemon=True).start()
+    data = chunk_queue.get()
+    while data is not None:
+        if isinstance(data, BaseException):
+            raise data
+        yield data
+        data = chunk_queue.get()
+
+
+def copyFromImage(output_filehandle, offset, size):
+    # Copies a part of the image to an output file, a block at a time.
+    # RAW images are copied in the kernel with copy_file_range or sendfile, without reading the data into Python.
+    end = offset + size
+    while offset < end:
+        block_end = min(offset + copy_block_length, end)
+        if image_map is None:
+            copied = output_filehandle.write(readFromImage(block_end - offset, offset))
+        else:
+            try:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(filehandle.fileno(), output_filehandle.fileno(), end - offset, offset)
+                else:
+                    copied = os.sendfile(output_filehandle.fileno(), filehandle.fileno(), offset, end - offset)
+            except (AttributeError, OSError):
+                # Not supported on this platform or between these files, for example across file systems. Write from the memory map.
+                copied = output_filehandle.write(image_map[offset: block_end])
+        if not copied:
+            break
+        offset += copied
+
+
+def releaseScannedImage(offset):
+    # Tells the kernel that the scanned part of a RAW image will not be read again soon.
+    # The pages are unmapped first, the kernel doesn't drop pages from the cache while they are mapped.
+    # Blocks saved later are read from disk again, only the cache is affected.
+    global released_until
+    release_end = (offset - release_behind_length) // mmap.PAGESIZE * mmap.PAGESIZE
+    if image_map is None or release_end <= released_until:
+        return
+    if hasattr(mmap, 'MADV_DONTNEED'):
+        image_map.madvise(mmap.MADV_DONTNEED, released_until, release_end - released_until)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(filehandle.fileno(), released_until, release_end - released_until, os.POSIX_FADV_DONTNEED)
+    released_until = release_end
+
+
+def searchBytes(size, offset, data=None):
+    # Memory mapped images are searched in place, other images are read into a buffer if not already read.
+    if data is None and image_map is not None:
+        matches = carve_re.finditer(image_map, offset, min(offset + size, total_size))
+    else:
+        if data is None:
+            data = readFromImage(size, offset)
+        matches = carve_re.finditer(data)
+        offset = 0
+    # Hits starting in the overlap are left to the next chunk. The hits are returned lazily as they are found.
+    return (match.start() - offset for match in matches if match.start() - offset < carve_haystack_length)
 
 
 EPOCH_AS_FILETIME = 116444736000000000  # January 1, 1970 as filetime
 HUNDREDS_OF_NS = 10000000
 
 
-def getFiletime(date_data):
-    date_long_value = struct.unpack("<Q", date_data)[0]
-
+def getFiletime(date_long_value):
     # Code from https://github.com/jleclanche/winfiletime Because pip winfiletime contains an error.
-    # Get seconds and remainder in terms of Unix epoch
-    s, ns100 = divmod(date_long_value - EPOCH_AS_FILETIME, HUNDREDS_OF_NS)
-    # Convert to datetime object, with remainder as microseconds.
-    date_value = datetime.utcfromtimestamp(s).replace(microsecond=(ns100 // 10))
-
-    return date_value
+    # Returns the time as a tuple of seconds and remainder (100 ns) since 01.01.1970.
+    return divmod(date_long_value - EPOCH_AS_FILETIME, HUNDREDS_OF_NS)
 
 
 def getLongBigEndian(value):
@@ -112,28 +189,21 @@ def getLongLittleEndian(value):
 
 
 def getDateTimeString(value):
-    return datetime.strftime(value, '%Y-%m-%d_%H%M%S')
+    s, ns100 = value
+    return time.strftime('%Y-%m-%d_%H%M%S', time.gmtime(s))
 
 
-def extractDate(header):
-    date_bytes = header[header_date_offset : header_date_offset + header_date_length]
-    return getDateTimeString(getFiletime(date_bytes))
-
-
-def extractSize(header):
-    size_bytes = header[header_size_offset : header_size_offset + header_size_length]
-    return getLongLittleEndian(size_bytes)
-
-
-def saveToFile(start_offset, end_offset, count, start_date, end_date):
+def saveToFile(start_offset, end_offset, count, start_filetime, end_filetime):
+    start_date = getDateTimeString(getFiletime(start_filetime))
+    end_date = getDateTimeString(getFiletime(end_filetime))[11:17]
     if not os.path.exists(output_path):
         os.makedirs(output_path)
     filename = "blk_" + start_date + "-" + end_date + "_" + str(count) + "_" + str(
         start_offset) + "_" + str(end_offset) + ".blk"
     output_file = os.path.join(output_path, filename)
     print(output_file)
-    with open(output_file, 'wb') as f:
-        f.write(readFromImage((end_offset - start_offset), start_offset))
+    with open(output_file, 'wb', buffering=0) as f:
+        copyFromImage(f, start_offset, end_offset - start_offset)
 
 
 def searchChunksOfData():
@@ -144,47 +214,65 @@ def searchChunksOfData():
     current_blk_start_offset = 0
     current_blk_end_offset = 0
     current_blk_count = 0
-    current_blk_start_date = "null"
-    current_blk_end_date = "null"
+    current_blk_start_date = None
+    current_blk_end_date = None
 
     progress_report = total_size / 100
     next_progress_report = 0
-    log_offset_counter = 0
-    log_offset_to_file = 200000
+    log_offset_to_file = 64 * 1024 * 1024
+    next_log_offset = offset + log_offset_to_file
     log_file = os.path.join(output_path, "currentOffset.log")
+    log_filehandle = None
+
+    # Memory mapped images are prefetched by the kernel, other images are read ahead in a thread.
+    chunks = None
+    if image_map is None:
+        chunks = readChunksInBackground(offset)
 
     while offset < total_size:
-        log_offset_counter += 1
-        if log_offset_counter > log_offset_to_file:
-            log_offset_counter = 0
-            with open(log_file, 'w') as f:
-                f.write(str(offset))
+        if offset >= next_log_offset:
+            next_log_offset = offset + log_offset_to_file
+            # The log is opened once, and overwritten for every new offset.
+            if log_filehandle is None:
+                log_filehandle = open(log_file, 'w')
+            log_filehandle.seek(0)
+            log_filehandle.write(str(offset))
+            log_filehandle.truncate()
+            log_filehandle.flush()
 
         if offset >= next_progress_report:
             print("Searching... " + str(100 * offset // total_size) + "% Current offset: " + str(
                 offset) + " / " + str(total_size))
             next_progress_report = next_progress_report + progress_report
 
-        hits = searchBytes(full_haystack_length, offset)
-        if len(hits) > 0:
-            for hit in hits:
-                hit_offset = offset + hit
-                header = readFromImage(header_length, hit_offset)
-                blk_date = extractDate(header)
-
-                if hit_offset > current_blk_end_offset:
-                    if current_blk_count > 0:
-                        saveToFile(current_blk_start_offset, current_blk_end_offset, current_blk_count,
-                                   current_blk_start_date, current_blk_end_date)
-                        current_blk_count = 0
-                    current_blk_start_offset = hit_offset
-                    current_blk_start_date = blk_date
-                current_blk_size = extractSize(header)
-                current_blk_end_offset = hit_offset + header_length + current_blk_size
-                current_blk_end_date = blk_date[11:17]
-                current_blk_count = current_blk_count + 1
+        if chunks is not None:
+            hits = searchBytes(full_haystack_length, offset, next(chunks))
+        else:
+            prefetchImage(full_haystack_length, offset + offset_skip)
+            hits = searchBytes(full_haystack_length, offset)
+        for hit in hits:
+            hit_offset = offset + hit
+            # The date is kept as filetime, it is only formatted when a block is saved.
+            if image_map is not None:
+                blk_date, current_blk_size = header_struct.unpack_from(image_map, hit_offset)
+            else:
+                blk_date, current_blk_size = header_struct.unpack_from(readFromImage(header_length, hit_offset))
+
+            if hit_offset > current_blk_end_offset:
+                if current_blk_count > 0:
+                    saveToFile(current_blk_start_offset, current_blk_end_offset, current_blk_count,
+                               current_blk_start_date, current_blk_end_date)
+                    current_blk_count = 0
+                current_blk_start_offset = hit_offset
+                current_blk_start_date = blk_date
+            current_blk_end_offset = hit_offset + header_length + current_blk_size
+            current_blk_end_date = blk_date
+            current_blk_count = current_blk_count + 1
 
         offset = offset + offset_skip
+        releaseScannedImage(offset)
+    if log_filehandle is not None:
+        log_filehandle.close()
     if current_blk_count > 0:
         saveToFile(current_blk_start_offset, current_blk_end_offset, current_blk_count, current_blk_start_date,
                    current_blk_end_date)
@@ -202,5 +290,12 @@ if image_file[-4:].upper() == ".E01":
 else:
     filehandle = open(image_file_path, 'rb')
     total_size = os.fstat(filehandle.fileno()).st_size
+    if total_size > 0:
+        # Memory map RAW images, reads are then slices of the map instead of seek and read.
+        image_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            image_map.madvise(mmap.MADV_SEQUENTIAL)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(filehandle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
 searchChunksOfData()
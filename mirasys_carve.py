@@ -10,9 +10,15 @@
 # Version: 0.2
 
 import argparse
+import bisect
+import collections
+import functools
+import mmap
+import multiprocessing
 import os
 import re
 import struct
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 parser = argparse.ArgumentParser(description='Scans image-files (RAW or EWF) for video files within a timeframe. '
@@ -34,6 +40,8 @@ image_folder_path, image_file = os.path.split(os.path.realpath(image_file_path))
 output_path = os.path.join(image_folder_path, "output")
 if args.output:
     output_path = args.output
+# Output files are named 'output/dvrfile_yyyy-mm-dd_hhmmss-hhmmss_count_start_end.dat'
+output_file_prefix = os.path.join(output_path, "dvrfile_")
 
 resume_offset = 0
 if args.resume:
@@ -43,22 +51,14 @@ if args.resume:
 def getBytesFromString(string):
     # Returns a string converted to bytes. Hex-values converted, but not other characters.
     # Example: "[\x41-\x5A]" =>b'[A-Z]'
-    result_bytes = b''
-    i = 0
-    while i < len(string):
-        if string[i] == "\\" and i + 4 <= len(string):
-            result_bytes += bytes.fromhex(string[i+2:i+4])
-            i += 4
-        else:
-            result_bytes += bytes(string[i], 'utf-8')
-            i += 1
-    return result_bytes
+    return re.sub(rb'\\x([0-9A-Fa-f]{2})', lambda match: bytes.fromhex(match.group(1).decode()), string.encode('utf-8'))
 
 
 date_regex = getBytesFromString(args.timeframe)
 
 total_size = 0
 filehandle = None
+image_map = None
 
 file_signature = "\\x03\\xE0\\xDD\\x00"
 file_offset_to_index_overview = 30
@@ -66,14 +66,17 @@ index_overview_pattern = "<TIMEFRAME><OFFSET><SIZE>"
 
 index_signature = "\\x95\\xFD\\xB7\\x14"
 index_length = 4096
+# An allocated, but unused index cluster is only zeros.
+empty_index = bytes(index_length)
+# Indexes are often stored in groups of clusters, this many clusters are read at once.
+index_group_length = 16 * index_length
 index_frames_count = (10, 4)
 index_frames_start = 14
 index_frame_signature = "\\xA6\\x4B"
 index_frame_carve_string = "\\xA6\\x4B.{3}<TIMEFRAME>"
 index_frame_length = 32
-index_frame_date = (5, 13)
-index_frame_offset = (13, 21)
-index_frame_size = (21, 25)
+# Index frame entry: signature at 0, date (ticks) at 5, offset at 13 and size at 21.
+index_frame_struct = struct.Struct('<2s3x8sQI7x')
 
 frame_signature = "\\x97\\x57\\x20\\x58"
 frame_carve_string = "\\x97\\x57\\x20\\x58.{6}<TIMEFRAME>"
@@ -93,17 +96,144 @@ frame_signature = getBytesFromString(frame_signature)
 frame_carve_string = getBytesFromString(frame_carve_string)
 frame_carve_string = frame_carve_string.replace(b'<TIMEFRAME>', date_regex)
 
+# The carve strings are compiled once, not for every haystack.
+index_frame_carve_re = re.compile(index_frame_carve_string, flags=re.DOTALL)
+frame_carve_re = re.compile(frame_carve_string, flags=re.DOTALL)
+
+# The image is searched in large windows. After an index the scan continues one cluster after the last frame.
+carve_window_length = 8 * 1024 * 1024
 offset_skip = carve_haystack_length
-full_haystack_length = carve_haystack_length + carve_string_length
+# Output files are copied from the image in blocks of this size.
+copy_block_length = 1024 * 1024
+# RAW images are split into ranges of this size, searched for carve strings by one worker process each.
+range_length = 64 * 1024 * 1024
+# Ranges submitted to the workers ahead of the scan, more would only hold their matches in memory.
+ranges_in_flight = 2 * (os.cpu_count() or 1)
+
+# Matches found by the worker processes, (offset, end) sorted by offset for each signature.
+# range_results yields the results of the ranges in image order, found_until is the end of the last one received.
+# The scan moves forward, matches before found_from are dropped.
+found_matches = {}
+range_results = None
+found_from = 0
+found_until = 0
 
 
 def readFromImage(offset, size):
+    if image_map is not None:
+        return image_map[offset: offset + size]
     filehandle.seek(offset)
     return filehandle.read(size)
 
-def searchBytes(offset, size, carve_string):
-    data = readFromImage(offset, size)
-    carve_list = [match.start() for match in re.finditer(carve_string, data, flags=re.DOTALL)]
+def prefetchImage(offset, size):
+    # Asks the kernel to read ahead a part of a memory mapped image.
+    if image_map is None or not hasattr(mmap, 'MADV_WILLNEED') or offset >= total_size:
+        return
+    start = (offset // mmap.PAGESIZE) * mmap.PAGESIZE
+    image_map.madvise(mmap.MADV_WILLNEED, start, min(offset + size, total_size) - start)
+
+
+def copyFromImage(output_filehandle, offset, size):
+    # Copies a part of the image to an output file, a block at a time.
+    # RAW images are copied in the kernel with copy_file_range or sendfile, without reading the data into Python.
+    end = offset + size
+    while offset < end:
+        block_end = min(offset + copy_block_length, end)
+        if image_map is None:
+            copied = output_filehandle.write(readFromImage(offset, block_end - offset))
+        else:
+            try:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(filehandle.fileno(), output_filehandle.fileno(), end - offset, offset)
+                else:
+                    copied = os.sendfile(output_filehandle.fileno(), filehandle.fileno(), offset, end - offset)
+            except (AttributeError, OSError):
+                # Not supported on this platform or between these files, for example across file systems. Write from the memory map.
+                copied = output_filehandle.write(image_map[offset: block_end])
+        if not copied:
+            break
+        offset += copied
+
+
+def searchRange(range_start):
+    # Runs in a worker process. Returns (offset, end) of every match of the carve strings starting within the range.
+    # Unlike searchBytes(), matches may overlap, searchFoundMatches() picks the same matches as searchBytes().
+    range_end = min(range_start + range_length, total_size)
+    end = min(range_end + carve_string_length, total_size)
+    result = {}
+    for signature, carve_re in ((index_frame_signature, index_frame_carve_re), (frame_signature, frame_carve_re)):
+        matches = []
+        match = carve_re.search(image_map, range_start, end)
+        while match and match.start() < range_end:
+            matches.append((match.start(), match.end()))
+            match = carve_re.search(image_map, match.start() + 1, end)
+        result[signature] = matches
+    return range_end, result
+
+
+def getRangeResults(executor, start):
+    # Yields the results of searchRange() in image order.
+    # Only ranges_in_flight ranges are submitted at a time, so the workers don't run far ahead of the scan.
+    futures = collections.deque()
+    for range_start in range(start, total_size, range_length):
+        futures.append(executor.submit(searchRange, range_start))
+        if len(futures) >= ranges_in_flight:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def searchFoundMatches(offset, size, signature, first_only=False):
+    # Same as searchBytes(), but using the matches found by the worker processes.
+    global found_from, found_until
+    # Wait for the ranges covering the search.
+    while found_until < min(offset + size, total_size):
+        found_until, result = next(range_results)
+        for result_signature, matches in result.items():
+            found_matches.setdefault(result_signature, []).extend(matches)
+
+    # Drop the matches before the search, the scan doesn't go back to them. searchBytes() searches the image itself
+    # if it does.
+    matches = found_matches.get(signature, [])
+    del matches[:bisect.bisect_left(matches, (offset,))]
+    found_from = offset
+
+    carve_list = []
+    next_start = offset
+    for match_index in range(bisect.bisect_left(matches, (offset,)), bisect.bisect_left(matches, (offset + size,))):
+        hit, match_end = matches[match_index]
+        if hit >= next_start:
+            carve_list.append(hit - offset)
+            if first_only:
+                break
+            next_start = match_end
+    return carve_list
+
+
+def searchBytes(offset, size, signature, carve_re, first_only=False):
+    # Returns the offsets of matches starting within size bytes from offset, or only the first one with first_only.
+    # The search continues carve_string_length bytes further, to find matches crossing the end.
+    if range_results is not None and offset >= found_from:
+        return searchFoundMatches(offset, size, signature, first_only)
+
+    # Memory mapped images are searched in place, other images are read into a buffer.
+    if image_map is not None:
+        data = image_map
+        start = offset
+        end = min(offset + size + carve_string_length, total_size)
+    else:
+        data = readFromImage(offset, size + carve_string_length)
+        start = 0
+        end = len(data)
+
+    # The carve strings start with the signature, re finds this literal prefix itself.
+    carve_list = []
+    for match in carve_re.finditer(data, start, end):
+        if match.start() >= start + size:
+            break
+        carve_list.append(match.start() - start)
+        if first_only:
+            break
     return carve_list
 
 
@@ -114,6 +244,8 @@ HUNDREDS_OF_NS = 10000000
 EPOCH_DIFF = 504911232000000000
 
 
+# The same frame date is converted for the index entry, the frame check and the frame itself.
+@functools.lru_cache(maxsize=4096)
 def getTicksTime(value):
     date_long_value = getLongLongLittleEndian(value)
     date_long_value -= EPOCH_DIFF
@@ -155,23 +287,20 @@ def extractSize(header):
 
 
 def saveToFile(start_offset, end_offset, count, start_date, end_date):
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-
-    filename = "dvrfile_" + start_date + "-" + end_date[11:17] + "_" + str(count) + "_" + str(
-        start_offset) + "_" + str(end_offset) + ".dat"
-    output_file = os.path.join(output_path, filename)
+    # The output folder is created by searchChunksOfData().
+    output_file = f'{output_file_prefix}{start_date}-{end_date[11:17]}_{count}_{start_offset}_{end_offset}.dat'
     print(output_file)
-    with open(output_file, 'wb') as f:
-        f.write(readFromImage(start_offset, (end_offset - start_offset)))
+    with open(output_file, 'wb', buffering=0) as f:
+        copyFromImage(f, start_offset, end_offset - start_offset)
 
 
-def getIndex(offset):
-    index_bytes = readFromImage(offset, index_length)
+def getIndex(index_group, start):
+    # Returns the index cluster at start in a group of clusters read from the image.
+    index_bytes = index_group[start: start + index_length]
     if checkSignature(index_bytes, index_signature):
         # Bytes start with a valid signature.
         return index_bytes
-    elif all(b == 0 for b in index_bytes):
+    elif index_bytes == empty_index:
         # Allocated indexes containing only zeros, return empty list.
         return []
     # Not a valid index, return None
@@ -184,34 +313,28 @@ def checkSignature(bytes_value, signature):
 
 def getFrameInfoFromIndex(found_index):
     result = []
-    offset = index_frames_start
-    while offset < len(found_index):
-        frame_bytes = found_index[offset: offset+index_frame_length]
-        if checkSignature(frame_bytes, index_frame_signature):
-            date_bytes = frame_bytes[index_frame_date[0]: index_frame_date[1]]
-            offset_bytes = frame_bytes[index_frame_offset[0]: index_frame_offset[1]]
-            size_bytes = frame_bytes[index_frame_size[0]: index_frame_size[1]]
-
-            result += [(getTicksTime(date_bytes), getLongLongLittleEndian(offset_bytes), getIntLittleEndian(size_bytes))]
-            offset += index_frame_length
-        else:
+    # Unpack all whole index frame entries in one go.
+    frames_end = index_frames_start + (len(found_index) - index_frames_start) // index_frame_length * index_frame_length
+    for signature, date_bytes, frame_offset, frame_size in index_frame_struct.iter_unpack(found_index[index_frames_start: frames_end]):
+        if signature != index_frame_signature:
             # Reached end of index. Pattern doesn't start with index_frame_signature
             break
+        result.append((getTicksTime(date_bytes), frame_offset, frame_size))
     return result
 
 
 def isIndexSameAsFrame(index, offset):
+    # Returns if the index points to a frame, and the frame header read to check it.
     potential_frame_header = readFromImage(offset, frame_header_length)
     if checkSignature(potential_frame_header, frame_signature):
         frame_date = extractDatetimeFromFrameHeader(potential_frame_header)
         # If the date in the first index is the same date in frame header. We have a hit.
-        return index[0] == frame_date
-    return False
+        return index[0] == frame_date, potential_frame_header
+    return False, potential_frame_header
 
 
 def searchChunksOfData():
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
+    os.makedirs(output_path, exist_ok=True)
 
     offset = resume_offset
     current_file_start = 0
@@ -222,100 +345,125 @@ def searchChunksOfData():
 
     progress_report = total_size / 100
     next_progress_report = offset
-    log_offset_counter = 0
-    log_offset_to_file = 200000
+    log_offset_to_file = 100 * 1024 * 1024
+    next_log_offset = offset + log_offset_to_file
     log_file = os.path.join(output_path, "currentOffset.log")
+    log_filehandle = None
 
     current_index = []
 
     while offset < total_size:
-        log_offset_counter += 1
-        if log_offset_counter > log_offset_to_file:
-            log_offset_counter = 0
-            with open(log_file, 'w') as f:
-                f.write(str(offset))
+        if offset >= next_log_offset:
+            next_log_offset = offset + log_offset_to_file
+            # The log is opened once, and overwritten for every new offset.
+            if log_filehandle is None:
+                log_filehandle = open(log_file, 'w')
+            log_filehandle.seek(0)
+            log_filehandle.write(str(offset))
+            log_filehandle.truncate()
+            log_filehandle.flush()
 
         if offset >= next_progress_report:
             print("Searching... " + str(100 * offset // total_size) + "% Current offset: " + str(
                 offset) + " / " + str(total_size))
             next_progress_report = next_progress_report + progress_report
 
-        index_frame_hits = searchBytes(offset, full_haystack_length, index_frame_carve_string)
+        # Search a large window of the image at a time, and read ahead the next window.
+        window_end = min(offset + carve_window_length, total_size)
+        prefetchImage(window_end, carve_window_length)
+
+        # Index starts at cluster start, the window is then only searched for frames up to the index.
+        # Only the first index is used, the scan continues after its file.
+        index_start = None
+        index_frame_hits = searchBytes(offset, window_end - offset, index_frame_signature, index_frame_carve_re,
+                                       first_only=True)
         if len(index_frame_hits) > 0:
-            # Index starts at cluster start
-            offset = ((offset + index_frame_hits[0]) // index_length) * index_length
-            found_index = getIndex(offset)
-            first_index = offset
-            index_group_count = 0
-            # Continue to read indexes because they can consist of groups.
-            while found_index:
-                index_group_count += 1
-                current_index += getFrameInfoFromIndex(found_index)
-
-                # Increase offset to check the next part.
-                offset += index_length
-                found_index = getIndex(offset)
-
-                # If the next part is not index, check if it's a frame.
-                if not found_index and isIndexSameAsFrame(current_index[0], offset):
-                    # Calculate start of file based on first frame after index.
-                    file_start = offset - current_index[0][1]
-                    if current_file_start != file_start:
-                        # There is a new file start. Write out the previous file.
-                        if current_file_count > 0:
-                            saveToFile(current_file_start, current_file_end, current_file_count,
-                                       current_file_start_date, current_file_end_date)
-                            current_file_count = 0
-                        current_file_start = file_start
-                        current_file_start_date = None
-
-            # Check index-pointers to frames. If they are equal, move the current file end.
-            for index in current_index:
-                if isIndexSameAsFrame(index, current_file_start + index[1]):
-                    offset = current_file_start + index[1]
-                    frame_header = readFromImage(offset, frame_header_length)
-                    frame_date = extractDatetimeStringFromFrameHeader(frame_header)
-                    if not current_file_start_date:
-                        current_file_start_date = frame_date
-                    current_file_end_date = frame_date
-
-                    offset = offset + index[2]
-                    current_file_end = offset
-                    current_file_count += 1
-                else:
-                    print("Didn't find frame: " + str(index[0]) + " Found " + str(current_file_count) + " frames")
-                    # There is no frame at expected offset. Write out the file.
+            index_start = ((offset + index_frame_hits[0]) // index_length) * index_length
+
+        # Search for 'orphan' frames, outside of indexes.
+        frames_end = window_end if index_start is None else max(index_start, offset)
+        hits = searchBytes(offset, frames_end - offset, frame_signature, frame_carve_re)
+        for hit in hits:
+            hit_offset = offset + hit
+            header = readFromImage(hit_offset, frame_header_length)
+            frame_date = extractDatetimeStringFromFrameHeader(header)
+
+            if hit_offset > current_file_end:
+                if current_file_count > 0:
+                    saveToFile(current_file_start, current_file_end, current_file_count,
+                               current_file_start_date, current_file_end_date)
+                    current_file_count = 0
+                current_file_start = hit_offset
+                current_file_start_date = frame_date
+            current_blk_size = extractSize(header)
+            current_file_end = hit_offset + frame_header_length + current_blk_size + footer_length
+            current_file_end_date = frame_date
+            current_file_count += 1
+
+        if index_start is None:
+            offset = window_end
+            continue
+
+        offset = index_start
+        index_group_offset = offset
+        index_group = readFromImage(offset, index_group_length)
+        found_index = getIndex(index_group, offset - index_group_offset)
+        first_index = offset
+        index_group_count = 0
+        # Continue to read indexes because they can consist of groups.
+        while found_index:
+            index_group_count += 1
+            current_index += getFrameInfoFromIndex(found_index)
+
+            # Increase offset to check the next part.
+            offset += index_length
+            if offset + index_length > index_group_offset + index_group_length:
+                index_group_offset = offset
+                index_group = readFromImage(offset, index_group_length)
+            found_index = getIndex(index_group, offset - index_group_offset)
+
+            # If the next part is not index, check if it's a frame.
+            if not found_index and isIndexSameAsFrame(current_index[0], offset)[0]:
+                # Calculate start of file based on first frame after index.
+                file_start = offset - current_index[0][1]
+                if current_file_start != file_start:
+                    # There is a new file start. Write out the previous file.
                     if current_file_count > 0:
-                        saveToFile(current_file_start, current_file_end, current_file_count, current_file_start_date,
-                                   current_file_end_date)
+                        saveToFile(current_file_start, current_file_end, current_file_count,
+                                   current_file_start_date, current_file_end_date)
                         current_file_count = 0
+                    current_file_start = file_start
                     current_file_start_date = None
-                    current_file_start = 0
-                    current_file_end = 0
-                    break
-            current_index = []
-        else:
-            # Else, if there were no hits in indexes, search for 'orphan' frames.
-            hits = searchBytes(offset, full_haystack_length, frame_carve_string)
-            if len(hits) > 0:
-                for hit in hits:
-                    hit_offset = offset + hit
-                    header = readFromImage(hit_offset, frame_header_length)
-                    frame_date = extractDatetimeStringFromFrameHeader(header)
-
-                    if hit_offset > current_file_end:
-                        if current_file_count > 0:
-                            saveToFile(current_file_start, current_file_end, current_file_count,
-                                       current_file_start_date, current_file_end_date)
-                            current_file_count = 0
-                        current_file_start = hit_offset
-                        current_file_start_date = frame_date
-                    current_blk_size = extractSize(header)
-                    current_file_end = hit_offset + frame_header_length + current_blk_size + footer_length
-                    current_file_end_date = frame_date
-                    current_file_count += 1
+
+        # Check index-pointers to frames. If they are equal, move the current file end.
+        for index in current_index:
+            is_same, frame_header = isIndexSameAsFrame(index, current_file_start + index[1])
+            if is_same:
+                offset = current_file_start + index[1]
+                frame_date = extractDatetimeStringFromFrameHeader(frame_header)
+                if not current_file_start_date:
+                    current_file_start_date = frame_date
+                current_file_end_date = frame_date
+
+                offset = offset + index[2]
+                current_file_end = offset
+                current_file_count += 1
+            else:
+                print("Didn't find frame: " + str(index[0]) + " Found " + str(current_file_count) + " frames")
+                # There is no frame at expected offset. Write out the file.
+                if current_file_count > 0:
+                    saveToFile(current_file_start, current_file_end, current_file_count, current_file_start_date,
+                               current_file_end_date)
+                    current_file_count = 0
+                current_file_start_date = None
+                current_file_start = 0
+                current_file_end = 0
+                break
+        current_index = []
 
         offset = offset + offset_skip
+    if log_filehandle is not None:
+        log_filehandle.close()
     if current_file_count > 0:
         saveToFile(current_file_start, current_file_end, current_file_count, current_file_start_date,
                    current_file_end_date)
@@ -333,5 +481,20 @@ if image_file[-4:].upper() == ".E01":
 else:
     filehandle = open(image_file_path, 'rb')
     total_size = os.fstat(filehandle.fileno()).st_size
-
-searchChunksOfData()
+    if total_size > 0:
+        # Memory map RAW images, reads are then slices of the map instead of seek and read.
+        image_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            image_map.madvise(mmap.MADV_SEQUENTIAL)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(filehandle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+# RAW images are searched for carve strings by several processes, the matches are then handled here in image order.
+# This script runs at import, the workers are forked so they don't run it again. Otherwise, search in this process.
+if image_map is not None and (os.cpu_count() or 1) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('fork')) as executor:
+        found_from = resume_offset
+        range_results = getRangeResults(executor, resume_offset)
+        searchChunksOfData()
+else:
+    searchChunksOfData()
@@ -8,6 +8,7 @@
 
 import argparse
 import glob
+import mmap
 import os
 import re
 import struct
@@ -17,19 +18,11 @@ from datetime import datetime
 def getBytesFromString(string):
     # Returns a string converted to bytes. Hex-values converted, but not other characters.
     # Example: "[\x41-\x5A]" =>b'[A-Z]'
-    result_bytes = b''
-    i = 0
-    while i < len(string):
-        if string[i] == "\\" and i + 4 <= len(string):
-            result_bytes += bytes.fromhex(string[i+2:i+4])
-            i += 4
-        else:
-            result_bytes += bytes(string[i], 'utf-8')
-            i += 1
-    return result_bytes
+    return re.sub(rb'\\x([0-9A-Fa-f]{2})', lambda match: bytes.fromhex(match.group(1).decode()), string.encode('utf-8'))
 
 
 filehandle = None
+file_map = None
 
 carve_string_length = 18
 carve_haystack_length = 4096
@@ -41,24 +34,25 @@ frame_footer_length = 20
 frame_header_date = (10, 8)
 frame_header_size = (31, 4)
 frame_carve_string = getBytesFromString(frame_signature)
+# The carve string is compiled once, not for every haystack.
+frame_carve_re = re.compile(frame_carve_string, flags=re.DOTALL)
 
 
 full_haystack_length = carve_haystack_length + carve_string_length
 
 
 def readFromImage(offset, size):
+    if file_map is not None:
+        return file_map[offset: offset + size]
     filehandle.seek(offset)
     return filehandle.read(size)
 
-def searchBytes(offset, size, carve_string):
-    data = readFromImage(offset, size)
-    carve_list = [match.start() for match in re.finditer(carve_string, data, flags=re.DOTALL)]
-    return carve_list
-
-
-def searchBytes(offset, size, carve_string):
+def searchBytes(offset, size, carve_re):
+    # Memory mapped files are searched in place, other files are read into a buffer.
+    if file_map is not None:
+        return [match.start() - offset for match in carve_re.finditer(file_map, offset, offset + size)]
     data = readFromImage(offset, size)
-    carve_list = [match.start() for match in re.finditer(carve_string, data, flags=re.DOTALL)]
+    carve_list = [match.start() for match in carve_re.finditer(data)]
     return carve_list
 
 
@@ -78,35 +72,34 @@ def extractSize(header):
     return getIntLittleEndian(size_bytes)
 
 
-def saveBodyToFile(file_path, start_offset, body_size):
-    with open(file_path, 'ab') as f:
-        f.write(readFromImage(start_offset, body_size))
+def saveBodyToFile(output_filehandle, start_offset, body_size):
+    output_filehandle.write(readFromImage(start_offset, body_size))
 
 
-def searchChunksOfData(total_size, output_file):
+def searchChunksOfData(total_size, output_filehandle):
     offset = 0
 
     while offset < total_size:
-        hits = searchBytes(offset, full_haystack_length, frame_carve_string)
+        hits = searchBytes(offset, full_haystack_length, frame_carve_re)
         if len(hits) > 0:
             for hit in hits:
                 hit_offset = offset + hit
                 header = readFromImage(hit_offset, frame_header_length)
                 body_size = extractSize(header)
                 # Save the body to file
-                saveBodyToFile(output_file, offset + frame_header_length, body_size)
+                saveBodyToFile(output_filehandle, offset + frame_header_length, body_size)
                 offset = hit_offset + frame_header_length + body_size + frame_footer_length
         else:
             offset += carve_haystack_length
 
-    result_text = "File saved: " + output_file + os.linesep
+    result_text = "File saved: " + output_filehandle.name + os.linesep
     result_text += "The videodata is not correctly stored in a video-container." + os.linesep
     result_text += "Recommended videoplayer: ffplay (ffmpeg) " + os.linesep
     print(result_text)
 
 
 def extractDataFromFile(dvr_file_path, output_path):
-    global filehandle
+    global filehandle, file_map
     folder_path, dvr_file = os.path.split(os.path.realpath(dvr_file_path))
 
     # Open file
@@ -114,6 +107,12 @@ def extractDataFromFile(dvr_file_path, output_path):
     filehandle = open(dvr_file_path, 'rb')
     total_size = os.fstat(filehandle.fileno()).st_size
     print("Success.")
+    file_map = None
+    if total_size > 0:
+        # Memory map the file, reads are then slices of the map instead of seek and read.
+        file_map = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            file_map.madvise(mmap.MADV_SEQUENTIAL)
 
     if not output_path:
         output_path = os.path.join(folder_path, "output")
@@ -123,7 +122,9 @@ def extractDataFromFile(dvr_file_path, output_path):
     # Base for file or folders are 'output/dvrfile_yyyy-mm-dd_hhmmss-hhmmss'
     output_file = os.path.join(output_path, dvr_file[:32] + ".mirasys")
 
-    searchChunksOfData(total_size, output_file)
+    # The output file is opened once, the body of every frame is appended to it.
+    with open(output_file, 'wb', buffering=1024 * 1024) as output_filehandle:
+        searchChunksOfData(total_size, output_filehandle)
 
 
 if __name__ == '__main__':
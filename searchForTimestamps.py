@@ -14,8 +14,12 @@
 # v0.3: Added endianness and big-endian
 
 import argparse
+import collections
+import mmap
+import multiprocessing
 import os
 import struct
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 import re
 
@@ -55,16 +59,27 @@ if args.endian[0] == 'l':
     endian_f = "<"
 else:
     endian_f = ">"
+# The timestamps are unpacked with the same format for every hit.
+long_long_struct = struct.Struct(endian_f + "Q")
+int_struct = struct.Struct(endian_f + "I")
 
+# The mapped file is searched in windows. All regexes run over a window while it is in the page cache.
+search_window_length = 64 * 1024 * 1024
+# The longest timestamp is 8 bytes, a hit starting in a window may end 7 bytes after it.
+timestamp_max_length = 8
+# Windows submitted to the workers ahead of the joined hits, more would only hold their hits in memory.
+windows_in_flight = 2 * (os.cpu_count() or 1)
 
-def createRegexRange(regex_prefix, regex_range, regex_range_step, regex_postfix):
-    if args.endian[0] == 'l':
-        regex_string = regex_prefix
-    else:
-        regex_string = ""
-        for i in range(len(regex_postfix), 0, -2):
-            regex_string += "\\x" + regex_postfix[i-2:i]
 
+def createRegexRange(regex_prefix, regex_range, regex_range_step, regex_postfix):
+    # The postfix bytes are the same in every match. Hits are found by searching for them before running the regex.
+    regex_literal = bytes.fromhex(regex_postfix)
+    if args.endian[0] == 'b':
+        regex_literal = regex_literal[::-1]
+    # The regex is built as bytes, every literal byte is escaped as \xhh.
+    literal_regex = b"".join(b"\\x%02x" % byte_value for byte_value in regex_literal)
+
+    range_regex = b""
     if regex_range:
         midpoint = int(regex_range, 16)
         range_from = midpoint - regex_range_step
@@ -76,20 +91,26 @@ def createRegexRange(regex_prefix, regex_range, regex_range_step, regex_postfix)
             if range_to > 0xff:
                 range_from = 0xff - regex_range_step - regex_range_step
                 range_to = 0xff
-        regex_string += f"[\x5cx{range_from:02x}-\x5cx{range_to:02x}]"
+        range_regex = b"[\\x%02x-\\x%02x]" % (range_from, range_to)
 
     if args.endian[0] == 'l':
-        for i in range(0, len(regex_postfix), 2):
-            regex_string += "\\x" + regex_postfix[i:i+2]
+        regex_bytes = regex_prefix.encode() + range_regex + literal_regex
+        literal_offset = int(regex_prefix[2:-1]) if regex_prefix.startswith(".{") else len(regex_prefix)
+        if regex_range:
+            literal_offset += 1
     else:
-        regex_string += regex_prefix
+        regex_bytes = literal_regex + range_regex + regex_prefix.encode()
+        literal_offset = 0
 
-    regex_string = regex_string.replace("0x", "\\x")
-    return bytes(regex_string, 'UTF-8')
+    # The regex is compiled once, not for every chunk of the file.
+    return re.compile(regex_bytes, flags=re.DOTALL), regex_literal, literal_offset
 
 
 def createRegexFor100NanoSeconds(dt, epoch):
     total_ticks = int((dt - epoch).total_seconds() * 10000000)
+    if not 0 <= total_ticks <= 0xFFFFFFFFFFFFFFFF:
+        # The datetime is outside of what this timestamp type can hold, don't search for it.
+        return None
     hex_string = struct.pack('<Q', total_ticks).hex()
     regex_prefix = ""
     regex_range = None
@@ -130,6 +151,8 @@ def createRegexForWinFiletime(dt):
 
 def createRegexForUnixsecond(dt):
     seconds = int(dt.timestamp())
+    if not 0 <= seconds <= 0xFFFFFFFF:
+        return None
     hex_string = struct.pack('<I', seconds).hex()
     regex_prefix = ""
     regex_range = None
@@ -160,6 +183,8 @@ def createRegexForUnixsecond(dt):
 
 def createRegexForUnixmicrosecond(dt):
     microseconds = int(dt.timestamp() * 1000000)
+    if not 0 <= microseconds <= 0xFFFFFFFFFFFFFFFF:
+        return None
     hex_string = struct.pack('<Q', microseconds).hex()
     regex_prefix = ""
     regex_range = None
@@ -196,6 +221,8 @@ def createRegexForApfsFiletime(dt):
     # 1 000 000 microsec=
     # 1 000 000 000 nanosec
     nanoseconds = int(dt.timestamp() * 1000000000)
+    if not 0 <= nanoseconds <= 0xFFFFFFFFFFFFFFFF:
+        return None
     hex_string = struct.pack('<Q', nanoseconds).hex()
     regex_prefix = ""
     regex_range = None
@@ -241,39 +268,130 @@ def getFiletimeFromLong(date_long_value):
     return date_value
 
 def getTicksTime(value):
-    date_long_value = struct.unpack(endian_f + "Q", value)[0]
+    date_long_value = long_long_struct.unpack(value)[0]
     date_long_value -= EPOCH_DIFF
     return getFiletimeFromLong(date_long_value)
 
 
 def getFiletime(value):
-    date_long_value = struct.unpack(endian_f + "Q", value)[0]
+    date_long_value = long_long_struct.unpack(value)[0]
     return getFiletimeFromLong(date_long_value)
 
 def getUnixseconds(value):
-    uintval = struct.unpack(endian_f + "I", value)[0]
+    uintval = int_struct.unpack(value)[0]
     return datetime.fromtimestamp(uintval)
 
 
 def getUnixmicroseconds(value):
-    uintval = struct.unpack(endian_f + "Q", value)[0]
-    return datetime.fromtimestamp(uintval / 1000000)
+    # Whole seconds and the remainder are split with integers, a float can't hold the full value.
+    s, us = divmod(long_long_struct.unpack(value)[0], 1000000)
+    return datetime.fromtimestamp(s).replace(microsecond=us)
 
 def getApfs(value):
-    uintval = struct.unpack(endian_f + "Q", value)[0]
-    return datetime.fromtimestamp(uintval / 1000000000)
+    s, ns = divmod(long_long_struct.unpack(value)[0], 1000000000)
+    return datetime.fromtimestamp(s).replace(microsecond=(ns // 1000))
+
+
+def findRegexHits(regex, regex_literal, literal_offset, pos, endpos, overlapping=False):
+    # Yields the same matches as regex.finditer(), but only runs the regex where the literal bytes are found.
+    # With overlapping, every offset the regex matches at is yielded, also inside the previous match.
+    # Only zero bytes are too common in images to search for first.
+    if not regex_literal.strip(b'\x00'):
+        match = regex.search(byte_array, pos, endpos)
+        while match:
+            yield match
+            match = regex.search(byte_array, match.start() + 1 if overlapping else match.end(), endpos)
+        return
+
+    literal_hit = byte_array.find(regex_literal, pos + literal_offset, endpos)
+    while literal_hit >= 0:
+        match = regex.match(byte_array, literal_hit - literal_offset, endpos)
+        if match and not overlapping:
+            yield match
+            literal_hit = byte_array.find(regex_literal, match.end() + literal_offset, endpos)
+        else:
+            if match:
+                yield match
+            literal_hit = byte_array.find(regex_literal, literal_hit + 1, endpos)
 
 
-def getRegexHits(regex, offset, timetype, name, getTimeMethod, color):
-    result = ""
+def getRegexHits(regex, start, end, offset):
+    # Returns the hits starting from file offset start until end, byte_array is read from file offset offset.
+    # Also returns where the next search with this regex starts, after the last hit.
+    result = []
+    search_start = end
     if regex:
-        ticks_hits = re.finditer(regex, byte_array, flags=re.DOTALL)
+        ticks_hits = findRegexHits(*regex, start - offset, end - offset + timestamp_max_length - 1)
         for hit in ticks_hits:
-            date_value = getTimeMethod(hit.group(0))
-            start = hex(hit.start() + offset)[2:]
-            size = hit.end() - hit.start()
-            result += timetype + " " + name + "," + datetime.strftime(date_value, '%Y-%m-%d %H:%M:%S') + \
-                      "," + start + "h," + str(size) + "h,Fg: Bg:0x" + color + os.linesep
+            if hit.start() + offset >= end:
+                break
+            search_start = max(end, hit.end() + offset)
+            result.append((hit.start() + offset, hit.group(0)))
+    return result, search_start
+
+
+def getAllRegexHits(start, end, offset):
+    # Runs every regex over the same part of the file. Each regex continues after its own last hit.
+    # The hits are kept as (file offset, index in searches, timestamp bytes), they are formatted after the search.
+    result = []
+    for i, search in enumerate(searches):
+        hits, search_starts[i] = getRegexHits(search[0], max(start, search_starts[i]), end, offset)
+        result += [(hit_offset, i, value) for hit_offset, value in hits]
+    return result
+
+
+def searchWindow(window_start):
+    # Runs in a worker process. Returns (file offset, timestamp bytes) of the matches of each regex in the window.
+    # Unlike getRegexHits(), matches may overlap, joinWindowHits() picks the same hits as getAllRegexHits().
+    window_end = min(window_start + search_window_length, total_size)
+    result = []
+    for search in searches:
+        hits = []
+        if search[0]:
+            for hit in findRegexHits(*search[0], window_start, window_end + timestamp_max_length - 1, True):
+                if hit.start() >= window_end:
+                    break
+                hits.append((hit.start(), hit.group(0)))
+        result.append(hits)
+    return result
+
+
+def getWindowResults(executor, window_starts):
+    # Yields the results of searchWindow() in file order.
+    # Only windows_in_flight windows are submitted at a time, so the workers don't run far ahead.
+    futures = collections.deque()
+    for window_start in window_starts:
+        futures.append(executor.submit(searchWindow, window_start))
+        if len(futures) >= windows_in_flight:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def joinWindowHits(window_hits):
+    # Same as getAllRegexHits(), but using the matches found by a worker process.
+    # The timestamp regexes have a fixed length, the first match not overlapping the last hit is the next hit.
+    result = []
+    for i, hits in enumerate(window_hits):
+        for hit_offset, value in hits:
+            if hit_offset >= search_starts[i]:
+                result.append((hit_offset, i, value))
+                search_starts[i] = hit_offset + len(value)
+    return result
+
+
+def getBookmarkLines(hits):
+    # Returns the hits as lines of the bookmark file.
+    # Bytes matching several timestamp types are only bookmarked once, as the first type in searches.
+    result = []
+    bookmarked = set()
+    for hit_offset, search_index, value in hits:
+        if (hit_offset, len(value)) in bookmarked:
+            continue
+        bookmarked.add((hit_offset, len(value)))
+        regex, timetype, name, getTimeMethod, color = searches[search_index]
+        date_value = getTimeMethod(value)
+        result.append(f"{timetype} {name},{date_value:%Y-%m-%d %H:%M:%S},{hit_offset:x}h,{len(value)}h,Fg: Bg:0x{color}\n")
     return result
 
 
@@ -293,29 +411,64 @@ if __name__ == "__main__":
         unixmicrosec_regex = createRegexForUnixmicrosecond(search_datetime)
     if args.types == "all" or "apfs" in args.types:
         apfs_regex = createRegexForApfsFiletime(search_datetime)
-    print(ticks_regex)
-    print(filetime_regex)
-    print(unixsec_regex)
-    print(unixmicrosec_regex)
-    print(apfs_regex)
-    result = ""
+    for regex in (ticks_regex, filetime_regex, unixsec_regex, unixmicrosec_regex, apfs_regex):
+        print(regex[0].pattern if regex else None)
+    searches = [(ticks_regex, "FILETIME", "Micosoft Tics", getTicksTime, "FF3399"),
+                (filetime_regex, "FILETIME", "Windows Filetime", getFiletime, "2525B9"),
+                (unixsec_regex, "time_t", "Unix Seconds", getUnixseconds, "B92525"),
+                (unixmicrosec_regex, "time_t", "Unix Microseconds", getUnixmicroseconds, "2C85DE"),
+                (apfs_regex, "time64_t", "APFS ", getApfs, "B366FF")]
+    search_starts = [0] * len(searches)
+    hits = []
     with open(filename, 'rb') as f:
-        offset = 0
-        jump = 512
-        byte_array = f.read(512)
-        while byte_array:
-            result += getRegexHits(ticks_regex, offset, "FILETIME", "Micosoft Tics", getTicksTime, "FF3399")
-            result += getRegexHits(filetime_regex, offset, "FILETIME", "Windows Filetime", getFiletime, "2525B9")
-            result += getRegexHits(unixsec_regex, offset, "time_t", "Unix Seconds", getUnixseconds, "B92525")
-            result += getRegexHits(unixmicrosec_regex, offset, "time_t", "Unix Microseconds", getUnixmicroseconds, "2C85DE")
-            result += getRegexHits(apfs_regex, offset, "time64_t", "APFS ", getApfs, "B366FF")
-
+        total_size = os.fstat(f.fileno()).st_size
+        if total_size > 0:
+            # Memory map the file, the windows then overlap and find the timestamps crossing their ends.
+            # The disk is read once, the regexes search each window in memory.
+            byte_array = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                byte_array.madvise(mmap.MADV_SEQUENTIAL)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            window_starts = range(0, total_size, search_window_length)
+            if len(window_starts) > 1 and (os.cpu_count() or 1) > 1 and \
+                    'fork' in multiprocessing.get_all_start_methods():
+                # The windows are searched by several processes, the hits are then joined here in file order.
+                # The workers are forked, they get the map and the regexes from this process.
+                with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                         mp_context=multiprocessing.get_context('fork')) as executor:
+                    for window_hits in getWindowResults(executor, window_starts):
+                        hits += joinWindowHits(window_hits)
+            else:
+                for window_start in window_starts:
+                    hits += getAllRegexHits(window_start, min(window_start + search_window_length, total_size), 0)
+        else:
+            # Files without a size, like devices, are read in chunks.
+            # The end of a chunk is searched again with the next one, to find the timestamps crossing between them.
+            # Devices are read once from start to end, the chunks already searched are dropped from the page cache.
+            # Pipes can't be advised.
+            advise_kernel = hasattr(os, 'posix_fadvise') and f.seekable()
+            if advise_kernel:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            offset = 0
+            jump = 1024 * 1024
             byte_array = f.read(jump)
-            offset += jump
+            while byte_array:
+                next_chunk = f.read(jump)
+                end = offset + len(byte_array)
+                if next_chunk:
+                    end -= timestamp_max_length - 1
+                hits += getAllRegexHits(offset, end, offset)
+                if advise_kernel:
+                    os.posix_fadvise(f.fileno(), offset, end - offset, os.POSIX_FADV_DONTNEED)
+
+                byte_array = byte_array[end - offset:] + next_chunk
+                offset = end
+    result = getBookmarkLines(hits)
     if len(result) > 0:
         print("Result written to: " + output_filename)
         with open(output_filename, 'w') as outfile:
-            outfile.write("Name,Value,Start,Size,Color" + os.linesep)
-            outfile.write(result)
+            outfile.write("Name,Value,Start,Size,Color\n")
+            outfile.writelines(result)
     else:
         print("No result in search...")